@@ -4,7 +4,6 @@ setup.py for the `phonechars` library
 Requirements are listed in `requirements.txt`.
 """
 
-
 # Import Python standard libraries
 from setuptools import setup, find_packages
 import pathlib
@@ -30,10 +29,17 @@ setup(
         "Topic :: Software Development :: Libraries",
     ],
     description="Extract phonological phylogenetic characters from aligned data",
-    entry_points={"console_scripts": ["phonechars=phonechars.__main__:main"]},
+    entry_points={
+        "console_scripts": [
+            "phonechars=phonechars.__main__:main",
+            "phonechars-query=phonechars.__main__:query",
+            "phonechars-check=phonechars.__main__:check",
+        ]
+    },
     extras_require={
         "dev": ["black", "flake8", "twine", "wheel", "build"],
         "test": ["pytest"],
+        "zstd": ["zstandard"],
     },
     include_package_data=True,
     install_requires=install_requires,
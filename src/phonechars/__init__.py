@@ -8,17 +8,51 @@ __author__ = "Tiago Tresoldi"
 __email__ = "tiago.tresoldi@lingfil.uu.se"
 
 # Import from local modules
-from .common import fetch_stream_data, chars2corr
-from .copar import build_lingpy_matrix, get_copar_results
+from .adapters import cldf2matrix, table2matrix
+from .common import fetch_stream_data, chars2corr, unslug_labels
+from .copar import build_lingpy_matrix, collapse_duplicate_rows, get_copar_results
+from .events import add_listener, remove_listener
+from .formats import write_beast_xml, write_fasta, write_phylip
+from .incremental import build_copar_state, update_copar_state
 from .ipa import ipa2xsampa
 from .nexus import corrdata2nexus
+from .output import OutputWriter, atomic_open, verify_manifest
+from .replicates import run_replicates
+from .sparse import CorrMatrix
+from .spill import chars2corr_spill, corrdata2matrix_spill
+from .store import export_sqlite
+from .subsets import run_subsets
+from .validate import WordlistIndex, index_records, index_wordlist
 
 # Build the namespace
 __all__ = [
+    "CorrMatrix",
+    "OutputWriter",
+    "WordlistIndex",
+    "add_listener",
+    "atomic_open",
+    "build_copar_state",
     "build_lingpy_matrix",
     "chars2corr",
+    "chars2corr_spill",
+    "cldf2matrix",
+    "collapse_duplicate_rows",
+    "corrdata2matrix_spill",
     "corrdata2nexus",
+    "export_sqlite",
     "fetch_stream_data",
     "get_copar_results",
+    "index_records",
+    "index_wordlist",
     "ipa2xsampa",
+    "remove_listener",
+    "run_replicates",
+    "run_subsets",
+    "table2matrix",
+    "unslug_labels",
+    "update_copar_state",
+    "verify_manifest",
+    "write_beast_xml",
+    "write_fasta",
+    "write_phylip",
 ]
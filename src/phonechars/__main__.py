@@ -10,9 +10,14 @@ Module for command-line extraction of phylogenetic phonological characters.
 
 # Import Python standard libraries
 import argparse
+import contextlib
 import logging
 from pathlib import Path
 import csv
+import shutil
+import sys
+import tempfile
+import typing
 
 # Import our library
 import phonechars
@@ -57,6 +62,37 @@ def parse_arguments() -> dict:
         type=str,
         help="Path to the nexus file to be generated; if not provided, it will be based on the input filename.",
     )
+    parser.add_argument(
+        "-f",
+        "--formats",
+        type=str,
+        nargs="+",
+        default=["nexus"],
+        choices=["nexus", "phylip", "fasta", "beast"],
+        help="Formats for the character matrix, written from a single computation; files other than the nexus one are named after it. Defaults to `nexus`.",
+    )
+    parser.add_argument(
+        "--min-doculects",
+        type=int,
+        default=1,
+        help="Prune from the character matrix the patterns observed in fewer doculects. Defaults to `1`.",
+    )
+    parser.add_argument(
+        "--min-states",
+        type=int,
+        default=1,
+        help="Prune from the character matrix the patterns with fewer distinct states; `2` drops constant characters. Defaults to `1`.",
+    )
+    parser.add_argument(
+        "--informative",
+        action="store_true",
+        help="Prune from the character matrix the patterns that are not parsimony informative.",
+    )
+    parser.add_argument(
+        "--max-states",
+        type=int,
+        help="Prune from the character matrix the patterns with more distinct states.",
+    )
     parser.add_argument(
         "-m",
         "--method",
@@ -65,6 +101,82 @@ def parse_arguments() -> dict:
         choices=["copar"],
         help="The method for extraction to be used.",
     )
+    parser.add_argument(
+        "--collapse",
+        action="store_true",
+        help="Collapse rows with identical doculect, cognate set, and alignment before running the method.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for shuffling the order of the alignment sites before clustering; results are reproducible for the same seed.",
+    )
+    parser.add_argument(
+        "--replicates",
+        type=int,
+        help="Number of seeded replicates to run in parallel, writing the consensus pattern and the stability of each site to a `.stability.tsv` file.",
+    )
+    parser.add_argument(
+        "-s",
+        "--state",
+        type=str,
+        help="Path to the state file for incremental updates; it is written after a full run, and read and updated with `--update`.",
+    )
+    parser.add_argument(
+        "-u",
+        "--update",
+        action="store_true",
+        help="Treat the input as new or changed rows, updating the run stored in the state file; output filenames default to ones based on the state filename.",
+    )
+    parser.add_argument(
+        "--jackknife",
+        action="store_true",
+        help="Also write a nexus file for each subset dropping one doculect.",
+    )
+    parser.add_argument(
+        "--subsets",
+        type=str,
+        help="Path to a tabular file with `SUBSET` and `DOCULECTS` (comma-separated) columns; a nexus file is also written for each subset.",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        help="Number of worker processes for running subsets and replicates; defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--structure-processes",
+        type=int,
+        default=1,
+        help="Number of worker processes for annotating the prosodic structure of large wordlists. Defaults to `1`.",
+    )
+    parser.add_argument(
+        "-z",
+        "--compression",
+        type=str,
+        choices=["gzip", "xz", "zstd"],
+        help="Compression for the output files, also extending their default filenames; if not provided, it is detected from the filename extensions.",
+    )
+    parser.add_argument(
+        "--sqlite",
+        type=str,
+        help="Path to a SQLite database to which chars and correspondences are also exported, for queries with `phonechars-query`.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        help="Maximum memory, in megabytes, for building correspondences and the character matrix, spilling intermediate data to temporary files.",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Display the progress of each stage of the pipeline on stderr.",
+    )
+    parser.add_argument(
+        "--events",
+        type=str,
+        help="Path to a file to which progress events are written as JSON lines, for external monitoring; if `-`, they are written to stdout.",
+    )
     parser.add_argument(
         "-v",
         "--verbosity",
@@ -81,43 +193,162 @@ def parse_arguments() -> dict:
 
 
 # TODO: decompose the full `args`, passing only the elements we need?
-def run_copar(input_file: str, delimiter: str):
+def run_copar(
+    index: phonechars.validate.WordlistIndex,
+    collapse: bool = False,
+    processes: typing.Optional[int] = None,
+    structure_processes: int = 1,
+    seed: typing.Optional[int] = None,
+    replicates: typing.Optional[int] = None,
+    stability_file: typing.Optional[Path] = None,
+    compression: typing.Optional[str] = None,
+):
     """
     Runs detection using the CoPAR method.
     """
 
-    # Obtain char information
-    source = phonechars.fetch_stream_data(input_file, "utf-8")
-    wordlist = phonechars.build_lingpy_matrix(source, delimiter)
-    chars = phonechars.get_copar_results(wordlist, "cogid")
+    # Obtain char information from the index built in the pre-flight check
+    wordlist, expansion = index.matrix(), None
+    if collapse:
+        wordlist, expansion = phonechars.collapse_duplicate_rows(wordlist)
+
+    if not replicates:
+        return phonechars.get_copar_results(
+            wordlist, "cogid", expansion, structure_processes, seed
+        )
+
+    # Run the replicates, writing the consensus of the sites
+    chars, consensus = phonechars.run_replicates(
+        wordlist, replicates, seed, expansion, processes
+    )
+    logging.info(f"Writing `{stability_file}`...")
+    with phonechars.atomic_open(stability_file, compression or "auto") as handler:
+        writer = csv.DictWriter(
+            handler,
+            delimiter="\t",
+            fieldnames=["COGID", "POSITION", "PATTERN", "STABILITY"],
+        )
+        writer.writeheader()
+        writer.writerows(consensus)
 
     return chars
 
 
-def obtain_corrs(char_file: str, corr_file: str):
+def run_copar_state(
+    index: phonechars.validate.WordlistIndex, state_file: str, update: bool
+):
     """
-    Extract correspondence phonological characters from a .chars.tsv file.
+    Runs detection using the CoPAR method, building or updating its state.
+
+    The state is returned along with the chars, so that it can be written
+    with the other outputs.
     """
 
-    # Log and extract base filename
-    logging.info(f"Processing `{char_file}`...")
+    if update:
+        state = phonechars.incremental.load_state(state_file)
+        report = phonechars.update_copar_state(state, index, None)
+        for key in ["added", "removed", "changed"]:
+            if report[key]:
+                logging.info(f"Characters {key}: {', '.join(report[key])}")
+    else:
+        state = phonechars.build_copar_state(index, None)
 
-    # Read data
-    with open(char_file, encoding="utf-8") as handler:
-        char_data = list(csv.DictReader(handler, delimiter="\t"))
+    return phonechars.incremental.state2chars(state), state
 
-    # Extract correspondences
-    corr_data = phonechars.chars2corr(char_data)
 
-    # Write to disk
-    with open(corr_file, "w", encoding="utf-8") as handler:
-        writer = csv.DictWriter(
-            handler, delimiter="\t", fieldnames=["DOCULECT", "CHAR", "PHONEME"]
-        )
-        writer.writeheader()
-        writer.writerows(corr_data)
+def strip_compression(path: Path) -> Path:
+    """
+    Return a path without the extension of a compression format, if any.
+    """
+
+    if phonechars.common.detect_compression(path):
+        return path.with_suffix("")
+
+    return path
+
+
+def run_subsets(
+    index: phonechars.validate.WordlistIndex,
+    nex_file: Path,
+    jackknife: bool,
+    subset_file: str,
+    processes: int,
+    compression: typing.Optional[str],
+):
+    """
+    Runs the analysis on subsets of doculects, writing a nexus file for each.
+    """
+
+    # Build the matrix only once, sharing it with all subsets
+    wordlist = index.matrix()
+
+    subsets = {}
+    if jackknife:
+        subsets.update(phonechars.subsets.jackknife_subsets(index))
+    if subset_file:
+        with phonechars.common.smart_open(subset_file, encoding="utf-8") as handler:
+            for row in csv.DictReader(handler, delimiter="\t"):
+                subsets[row["SUBSET"]] = [
+                    doculect.strip() for doculect in row["DOCULECTS"].split(",")
+                ]
+
+    # Name the files after the main nexus file, keeping its compression
+    if not compression:
+        compression = phonechars.common.detect_compression(nex_file)
+    nex_stem = strip_compression(nex_file).stem
+    extension = phonechars.common.COMPRESSION_EXTENSIONS.get(compression, "")
+
+    results = phonechars.run_subsets(wordlist, subsets, processes)
+    with phonechars.OutputWriter() as outputs:
+        for name, nexus_source in results.items():
+            outputs.submit(
+                nex_file.parent / f"{nex_stem}.{name}.nex{extension}",
+                lambda handler, source=nexus_source: handler.write(source),
+                compression,
+            )
+
+
+def write_chars(handler, char_data):
+    """
+    Write chars data to a .chars.tsv stream.
+    """
+
+    # Note that we always output TSV files
+    # TODO: drop STRUCTURE and other lingpy-only things?
+    writer = csv.DictWriter(
+        handler, delimiter="\t", fieldnames=phonechars.store.CHAR_FIELDS
+    )
+    writer.writeheader()
+    writer.writerows(char_data)
+
+
+def write_corrs(handler, corr_data):
+    """
+    Write correspondences to a .corrs.tsv stream.
+    """
+
+    writer = csv.DictWriter(
+        handler, delimiter="\t", fieldnames=["DOCULECT", "CHAR", "PHONEME"]
+    )
+    writer.writeheader()
+    writer.writerows(corr_data)
 
-    return corr_data
+
+def copy_file(filename: Path, handler):
+    """
+    Copy the contents of a text file to a stream.
+    """
+
+    with open(filename, encoding="utf-8", newline="") as source:
+        shutil.copyfileobj(source, handler)
+
+
+def print_event(record: dict):
+    """
+    Print an event to stderr, as the listener for `--progress`.
+    """
+
+    print(phonechars.events.format_event(record), file=sys.stderr)
 
 
 def main():
@@ -136,57 +367,310 @@ def main():
     }
     logging.basicConfig(level=level_map[args["verbosity"]])
 
-    # Build filenames as needed
+    # Register the progress listeners, if requested, removing them (and
+    # closing the event file) when the run is over
+    with contextlib.ExitStack() as stack:
+        if args["progress"]:
+            phonechars.add_listener(print_event)
+            stack.callback(phonechars.remove_listener, print_event)
+        if args["events"]:
+            if args["events"] == "-":
+                event_handler = sys.stdout
+            else:
+                event_handler = stack.enter_context(
+                    open(args["events"], "w", encoding="utf-8")
+                )
+            listener = phonechars.events.json_lines_listener(event_handler)
+            phonechars.add_listener(listener)
+            stack.callback(phonechars.remove_listener, listener)
+
+        run_pipeline(args)
+
+
+def run_pipeline(args: dict):
+    """
+    Run the full pipeline, from the source data to all the outputs.
+
+    @param args: The command-line arguments, as returned by
+        `parse_arguments()`.
+    """
+
+    if args["update"] and not args["state"]:
+        raise ValueError("A state file is required for updates.")
+    if args["state"] and args["collapse"]:
+        raise ValueError("Collapsing rows is not supported with state files.")
+    if args["state"] and (args["seed"] is not None or args["replicates"]):
+        raise ValueError("Seeds and replicates are not supported with state files.")
+    prune = (
+        args["min_doculects"] > 1
+        or args["min_states"] > 1
+        or args["informative"]
+        or args["max_states"] is not None
+    )
+    if prune and args["max_memory"]:
+        raise ValueError("Pruning characters is not supported with `--max-memory`.")
+    if args["sqlite"] and args["max_memory"]:
+        raise ValueError("The SQLite export is not supported with `--max-memory`.")
+
+    # Build filenames as needed; when updating, the input only holds the
+    # changes, so the names are based on the state file
     input_file = Path(args["input"])
+    if args["update"]:
+        state_file = strip_compression(Path(args["state"]))
+        base_file = state_file.parent / Path(state_file.stem).stem
+    else:
+        base_file = strip_compression(input_file)
+
+    compression = args["compression"]
+    extension = phonechars.common.COMPRESSION_EXTENSIONS.get(compression, "")
 
     if not args["charfile"]:
-        char_file = input_file.parent / f"{input_file.stem}.chars.tsv"
+        char_file = base_file.parent / f"{base_file.stem}.chars.tsv{extension}"
     else:
         char_file = Path(args["charfile"])
 
     if not args["corrfile"]:
-        corr_file = input_file.parent / f"{input_file.stem}.corrs.tsv"
+        corr_file = base_file.parent / f"{base_file.stem}.corrs.tsv{extension}"
     else:
         corr_file = Path(args["corrfile"])
 
     if not args["nexfile"]:
-        nex_file = input_file.parent / f"{input_file.stem}.nex"
+        nex_file = base_file.parent / f"{base_file.stem}.nex{extension}"
     else:
         nex_file = Path(args["nexfile"])
 
+    # Read and validate the source, failing on malformed rows before any
+    # expensive work; the index is shared by the later stages
+    source = phonechars.fetch_stream_data(str(input_file), "utf-8")
+    index = phonechars.index_wordlist(source, args["delimiter"])
+
     # Dispatch to the right method for generating .chars.tsv files
+    state = None
     if args["method"] == "copar":
-        copar_chars = run_copar(str(input_file), args["delimiter"])
-        # Write results to disk; note that we always output TSV files
-        # TODO: drop STRUCTURE and other lingpy-only things?
-        with open(char_file, "w", encoding="utf-8") as handler:
-            writer = csv.DictWriter(
-                handler,
-                delimiter="\t",
-                fieldnames=[
-                    "ID",
-                    "DOCULECT",
-                    "CONCEPT",
-                    "IPA",
-                    "TOKENS",
-                    "COGID",
-                    "ALIGNMENT",
-                    "STRUCTURE",
-                    "PATTERNS",
-                ],
+        if args["state"]:
+            copar_chars, state = run_copar_state(index, args["state"], args["update"])
+        else:
+            copar_chars = run_copar(
+                index,
+                args["collapse"],
+                args["processes"],
+                args["structure_processes"],
+                args["seed"],
+                args["replicates"],
+                base_file.parent / f"{base_file.stem}.stability.tsv{extension}",
+                compression,
             )
-            writer.writeheader()
-            writer.writerows(copar_chars)
     else:
         raise ValueError(f"Invalid extraction method `{args['method']}`.")
 
-    # Extract correspondences from a .chars.tsv file
-    corr_data = obtain_corrs(char_file, corr_file)
+    # Extract correspondences; with `--max-memory`, they are spilled once to a
+    # temporary file, which is both copied to the output and streamed for
+    # building the matrix
+    max_memory = args["max_memory"] * 1024 * 1024 if args["max_memory"] else None
+    if max_memory:
+        corr_data = None
+    else:
+        corr_data = phonechars.chars2corr(copar_chars)
+
+    # Export to SQLite, if requested
+    if args["sqlite"]:
+        phonechars.store.export_sqlite(args["sqlite"], copar_chars, corr_data)
+
+    # Write all outputs in background threads, committing them only when all
+    # are complete, along with the manifest
+    manifest_file = base_file.parent / f"{base_file.stem}.manifest.json"
+    if max_memory:
+        spill_dir = tempfile.TemporaryDirectory()
+    else:
+        spill_dir = contextlib.nullcontext()
+    with spill_dir as directory, phonechars.OutputWriter(manifest_file) as outputs:
+        if state is not None:
+            outputs.submit(
+                args["state"],
+                lambda handler: phonechars.incremental.write_state(handler, state),
+            )
+        outputs.submit(
+            char_file,
+            lambda handler: write_chars(handler, copar_chars),
+            compression or "auto",
+        )
+        if max_memory:
+            spill_file = Path(directory) / "corrs.tsv"
+            with open(spill_file, "w", encoding="utf-8", newline="") as handler:
+                write_corrs(
+                    handler,
+                    phonechars.spill.chars2corr_spill(copar_chars, max_memory),
+                )
+            outputs.submit(
+                corr_file,
+                lambda handler: copy_file(spill_file, handler),
+                compression or "auto",
+            )
+        else:
+            outputs.submit(
+                corr_file,
+                lambda handler: write_corrs(handler, corr_data),
+                compression or "auto",
+            )
+
+        # Build the character matrix only once, writing it in all requested
+        # formats; files other than the nexus one are named after it, keeping
+        # its compression
+        if max_memory:
+            with open(spill_file, encoding="utf-8", newline="") as handler:
+                matrix_data = phonechars.spill.corrdata2matrix_spill(
+                    csv.DictReader(handler, delimiter="\t"), max_memory
+                )
+        elif prune:
+            corr_matrix, removed = phonechars.CorrMatrix.from_rows(corr_data).prune(
+                args["min_doculects"],
+                args["min_states"],
+                args["informative"],
+                args["max_states"],
+            )
+            for rule, count in removed.items():
+                logging.info(f"Characters pruned by `{rule}`: {count}")
+            if not corr_matrix.patterns:
+                raise ValueError(
+                    "No characters left after pruning "
+                    f"({sum(removed.values())} removed)."
+                )
+            matrix_data = phonechars.nexus.corrdata2matrix(corr_matrix)
+        else:
+            matrix_data = phonechars.nexus.corrdata2matrix(corr_data)
+
+        matrix_compression = compression or phonechars.common.detect_compression(
+            nex_file
+        )
+        for output_format in args["formats"]:
+            writer, suffix = phonechars.formats.WRITERS[output_format]
+            if output_format == "nexus":
+                output_file = nex_file
+            else:
+                output_file = strip_compression(nex_file).with_suffix(suffix)
+                output_file = output_file.with_name(
+                    output_file.name
+                    + phonechars.common.COMPRESSION_EXTENSIONS.get(
+                        matrix_compression, ""
+                    )
+                )
+
+            outputs.submit(
+                output_file,
+                lambda handler, writer=writer: writer(handler, *matrix_data),
+                matrix_compression,
+            )
+
+    # Run the analysis on subsets of doculects, if requested
+    if args["jackknife"] or args["subsets"]:
+        run_subsets(
+            index,
+            nex_file,
+            args["jackknife"],
+            args["subsets"],
+            args["processes"],
+            compression,
+        )
+
+
+def query():
+    """
+    Main function for the `phonechars-query` command line tool.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Query chars and correspondences exported to a SQLite database."
+    )
+    parser.add_argument("database", type=str, help="Path to the SQLite database.")
+    parser.add_argument(
+        "--doculect",
+        type=str,
+        help="List the patterns where this doculect has the phoneme given by `--phoneme`.",
+    )
+    parser.add_argument(
+        "--phoneme",
+        type=str,
+        help="The phoneme for `--doculect`, either in IPA or as in the correspondences.",
+    )
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        help="List the cognate sets with sites in this pattern (e.g., `c100`).",
+    )
+    parser.add_argument(
+        "--nexus",
+        action="store_true",
+        help="Output the NEXUS source built from the stored correspondences.",
+    )
+    args = parser.parse_args().__dict__
+
+    if args["doculect"] or args["phoneme"]:
+        if not (args["doculect"] and args["phoneme"]):
+            parser.error("`--doculect` and `--phoneme` must be used together.")
+        for pattern in phonechars.store.query_patterns(
+            args["database"], args["doculect"], args["phoneme"]
+        ):
+            print(pattern)
+
+    if args["pattern"]:
+        for cogid in phonechars.store.query_cogsets(args["database"], args["pattern"]):
+            print(cogid)
+
+    if args["nexus"]:
+        corr_data = phonechars.store.load_corr_data(args["database"])
+        print(phonechars.corrdata2nexus(corr_data), end="")
+
+
+def check():
+    """
+    Main function for the `phonechars-check` command line tool.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Validate a tabular source before running the analysis."
+    )
+    parser.add_argument(
+        "input",
+        type=str,
+        help="Path to the tabular file with the source data. If `-`, will read from stdin.",
+    )
+    parser.add_argument(
+        "-d",
+        "--delimiter",
+        type=str,
+        default="tab",
+        choices=["comma", "tab"],
+        help="Delimiter used in the source file. Defaults to `tab`.",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="Stop at the first invalid row instead of reporting all of them.",
+    )
+    args = parser.parse_args().__dict__
+
+    source = phonechars.fetch_stream_data(args["input"], "utf-8")
+    try:
+        index = phonechars.index_wordlist(
+            source, args["delimiter"], fail_fast=args["fail_fast"]
+        )
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
+
+    for error in index.errors:
+        print(error, file=sys.stderr)
+
+    print(f"Rows: {index.rows}")
+    print(f"Doculects: {len(index.doculects)}")
+    print(
+        f"Cognate sets: {len(index.cogsets)} "
+        f"({len(index.singletons())} with a single entry)"
+    )
+    print(f"Segments: {' '.join(sorted(index.alphabet))}")
 
-    # Build the nexus file from the corr csv file
-    nexus_source = phonechars.corrdata2nexus(corr_data)
-    with open(nex_file, "w", encoding="utf-8") as handler:
-        handler.write(nexus_source)
+    if index.errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
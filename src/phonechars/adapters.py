@@ -0,0 +1,160 @@
+"""
+Module with adapters for building LingPy matrices from other data sources.
+
+Besides tabular text files, handled by `build_lingpy_matrix()`, data can be
+read directly from column-oriented tables (pandas and polars data frames,
+Arrow tables) and from CLDF wordlists, selecting only the columns that are
+needed and with no intermediate text serialization.
+"""
+
+# Import Python standard libraries
+import csv
+import json
+import logging
+from pathlib import Path
+
+# Import local modules
+from .common import smart_open
+from .copar import DEFAULT_COLUMNS, entries2matrix, records2entries
+
+# Default CLDF columns for the FormTable and the CognateTable, keyed by their
+# CLDF properties
+CLDF_FORM_COLUMNS = {
+    "id": "ID",
+    "languageReference": "Language_ID",
+    "parameterReference": "Parameter_ID",
+    "form": "Form",
+    "segments": "Segments",
+}
+CLDF_COGNATE_COLUMNS = {
+    "formReference": "Form_ID",
+    "cognatesetReference": "Cognateset_ID",
+    "alignment": "Alignment",
+}
+
+
+def table2matrix(table, columns: dict = None, noid: bool = False):
+    """
+    Build a LingPy matrix from a pandas/polars data frame or an Arrow table.
+
+    Only the columns in use are selected from the table before the rows are
+    extracted. Segments and alignments can be given either as strings with
+    space-separated tokens or as lists of tokens.
+
+    @param table: The data frame or Arrow table.
+    @param columns: A dictionary mapping the keys of `DEFAULT_COLUMNS` to the
+        column names in the table, overriding the default ones.
+    @param noid: Whether to use a simple sequential index instead of the ID
+        column. Defaults to `False`.
+    @return: The LingPy matrix, as returned by `build_lingpy_matrix()`.
+    """
+
+    columns = {**DEFAULT_COLUMNS, **(columns or {})}
+    if noid:
+        columns.pop("id")
+
+    # Arrow tables have `column_names`, polars data frames `to_dicts()`, and
+    # pandas data frames neither
+    if hasattr(table, "column_names"):
+        selected = [name for name in columns.values() if name in table.column_names]
+        records = table.select(selected).to_pylist()
+    elif hasattr(table, "to_dicts"):
+        selected = [name for name in columns.values() if name in table.columns]
+        records = table.select(selected).to_dicts()
+    else:
+        selected = [name for name in columns.values() if name in table.columns]
+        records = table[selected].to_dict("records")
+
+    entries = records2entries(records, columns, noid)
+
+    return entries2matrix(entries)
+
+
+def _cldf_table(metadata: dict, component: str, defaults: dict):
+    """
+    Return the URL and the column names of a CLDF component.
+
+    @param metadata: The CLDF metadata, or an empty dictionary for the
+        default URLs and column names.
+    @param component: The name of the component (e.g., "FormTable").
+    @param defaults: The default column names, keyed by CLDF properties.
+    @return: A tuple with the URL of the table and the column names, keyed
+        by CLDF properties.
+    """
+
+    url = {"FormTable": "forms.csv", "CognateTable": "cognates.csv"}[component]
+    columns = dict(defaults)
+    for table in metadata.get("tables", []):
+        if table.get("dc:conformsTo", "").endswith(f"#{component}"):
+            url = table["url"]
+            for column in table.get("tableSchema", {}).get("columns", []):
+                prop = column.get("propertyUrl", "").split("#")[-1]
+                if prop in columns:
+                    columns[prop] = column["name"]
+
+    return url, columns
+
+
+def cldf2matrix(path: str):
+    """
+    Build a LingPy matrix from a CLDF wordlist with aligned cognates.
+
+    Forms are read from the FormTable and joined with the cognate sets and
+    alignments of the CognateTable; forms with no aligned cognate judgement
+    are skipped. If a metadata file is available, it is used for finding the
+    tables and their columns.
+
+    @param path: The path to the CLDF metadata file or to the directory with
+        the tables.
+    @return: The LingPy matrix, as returned by `build_lingpy_matrix()`.
+    """
+
+    path = Path(path)
+    if path.is_dir():
+        base_path = path
+        metadata_files = sorted(path.glob("*-metadata.json"))
+        metadata_file = metadata_files[0] if metadata_files else None
+    else:
+        base_path = path.parent
+        metadata_file = path
+
+    metadata = {}
+    if metadata_file:
+        with smart_open(metadata_file, encoding="utf-8") as handler:
+            metadata = json.load(handler)
+
+    # Collect the forms, keeping only the columns in use
+    url, form_columns = _cldf_table(metadata, "FormTable", CLDF_FORM_COLUMNS)
+    forms = {}
+    with smart_open(base_path / url, encoding="utf-8") as handler:
+        for row in csv.DictReader(handler):
+            forms[row[form_columns["id"]]] = {
+                "DOCULECT": row[form_columns["languageReference"]],
+                "CONCEPT": row[form_columns["parameterReference"]],
+                "IPA": row.get(form_columns["form"]),
+                "SEGMENTS": row.get(form_columns["segments"]),
+            }
+
+    # Join the cognate judgements with the forms
+    url, cognate_columns = _cldf_table(metadata, "CognateTable", CLDF_COGNATE_COLUMNS)
+    records = []
+    skipped = 0
+    with smart_open(base_path / url, encoding="utf-8") as handler:
+        for row in csv.DictReader(handler):
+            alignment = row.get(cognate_columns["alignment"])
+            if not alignment:
+                skipped += 1
+                continue
+
+            record = dict(forms[row[cognate_columns["formReference"]]])
+            record["COGID"] = row[cognate_columns["cognatesetReference"]]
+            record["ALIGNMENT"] = alignment
+            records.append(record)
+
+    if skipped:
+        logging.warning("Skipped %i cognate judgements with no alignment.", skipped)
+
+    # CLDF identifiers are not necessarily numeric, so we use sequential ones
+    entries = records2entries(records, noid=True)
+
+    return entries2matrix(entries)
@@ -6,7 +6,11 @@ This is including methods that cannon be easily converted to JavaScript.
 # Import Python standard libraries
 from collections import defaultdict
 import contextlib
+import gzip
+import io
 import logging
+import lzma
+import re
 import sys
 import typing
 
@@ -14,17 +18,114 @@ import typing
 import chardet
 import unidecode
 
+# zstd support is optional, requiring the `zstandard` package
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Import local modules
 from . import ipa
+from .events import stage
+from .sparse import CorrMatrix
+
+# Replacements for ASCII characters not accepted in NEXUS labels by some
+# tools, applied by `slug_grapheme_label()` and undone by `unslug_labels()`
+SLUG_REPLACEMENTS = {
+    "?": "_GS_",  # glottal stop
+    "`": "_AP_",
+    "@": "_AT_",
+    ":": "_LG_",
+    "~": "_TD_",
+    "\\": "_SL_",
+}
+_UNSLUG_MAP = {target: source for source, target in SLUG_REPLACEMENTS.items()}
+_UNSLUG_PATTERN = re.compile("|".join(re.escape(target) for target in _UNSLUG_MAP))
+
+# The prefix of NEXUS character state labels (e.g., "c12_2_"); slugs never
+# start with a digit, as tones are prefixed with "TONE_"
+_CHARSTATE_PREFIX = re.compile(r"^c\d+(?:_\d+)*_")
+_TONE_PREFIX = "TONE_"
+
+# Magic bytes and filename extensions of the supported compression formats
+COMPRESSION_MAGIC = {
+    "gzip": b"\x1f\x8b",
+    "xz": b"\xfd7zXZ\x00",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "xz": ".xz", "zstd": ".zst"}
+
+
+def detect_compression(filename: str, header: bytes = b"") -> typing.Optional[str]:
+    """
+    Detect the compression format of a file, by its extension or magic bytes.
+
+    @param filename: The path to the file; its extension takes precedence.
+    @param header: The first bytes of the file, if available.
+    @return: The name of the compression format ("gzip", "xz", or "zstd"), or
+        `None` if the file is not compressed.
+    """
+
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if str(filename).endswith(extension):
+            return compression
+
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if header.startswith(magic):
+            return compression
+
+    return None
+
+
+def _compressed_stream(
+    fileobj: typing.IO, mode: str, compression: str, **kwargs: object
+) -> typing.IO:
+    """
+    Wrap a binary stream with a compression layer.
+
+    @param fileobj: The binary stream to be wrapped; it is not closed when
+        the returned stream is closed.
+    @param mode: The mode for the stream, as in `smart_open()`.
+    @param compression: The name of the compression format.
+    @param kwargs: Additional arguments for text streams, such as `encoding`.
+    @return: The wrapped stream.
+    """
+
+    reading = mode[0] == "r"
+    if compression == "gzip":
+        stream = gzip.GzipFile(fileobj=fileobj, mode="rb" if reading else "wb")
+    elif compression == "xz":
+        stream = lzma.LZMAFile(fileobj, mode="rb" if reading else "wb")
+    elif compression == "zstd":
+        if not zstandard:
+            raise ImportError("The `zstandard` package is required for zstd.")
+        if reading:
+            stream = zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+    else:
+        raise ValueError(f"Invalid compression `{compression}`.")
+
+    if "b" not in mode:
+        stream = io.TextIOWrapper(stream, **kwargs)
+
+    return stream
 
 
 @contextlib.contextmanager
 def smart_open(
-    filename: str, mode: str = "r", *args: object, **kwargs: object
+    filename: str,
+    mode: str = "r",
+    *args: object,
+    compression: typing.Optional[str] = "auto",
+    **kwargs: object,
 ) -> typing.IO:
     """
     Open files and i/o streams transparently.
 
+    Compressed streams (gzip, xz, and, if the `zstandard` package is
+    installed, zstd) are decompressed or compressed on the fly.
+
     Code originally from https://stackoverflow.com/a/45735618.
 
     @param filename: The full path to the file to be opened; if "-",
@@ -33,26 +134,59 @@ def smart_open(
     @param mode: The mode for opening the file, accepting normal values
         such as "r", "rb", "w", and "wb".
     @param args: Additional arguments for opening the stream, as passed
-        to `open()`.
+        to `open()` for uncompressed files.
+    @param compression: The compression format ("gzip", "xz", or "zstd"),
+        `None` for no compression, or "auto" for detection by the filename
+        extension or, when reading, by the magic bytes of the stream.
+        Defaults to "auto".
     @param kwargs: Any additional argument for opening the stream, as passed
         to `open()`.
     """
 
+    if mode not in ["r", "w", "rb", "wb"]:
+        raise ValueError("Invalid stream mode.")
+
     if filename == "-":
-        if mode == "r":
-            fh = sys.stdin
-        elif mode == "w":
-            fh = sys.stdout
-        elif mode == "rb":
-            fh = sys.stdin.buffer
-        elif mode == "wb":
-            fh = sys.stdout.buffer
+        if mode[0] == "r":
+            raw = sys.stdin.buffer
+            if compression == "auto":
+                compression = detect_compression("", raw.peek(6))
         else:
-            raise ValueError("Invalid stream mode.")
+            raw = sys.stdout.buffer
+            if compression == "auto":
+                compression = None
 
-        close = False
+        if compression:
+            fh = _compressed_stream(raw, mode, compression, **kwargs)
+        else:
+            fh = {
+                "r": sys.stdin,
+                "w": sys.stdout,
+                "rb": sys.stdin.buffer,
+                "wb": sys.stdout.buffer,
+            }[mode]
+        close = bool(compression)
     else:
-        fh = open(filename, mode, *args, **kwargs)
+        raw = None
+        if compression == "auto":
+            header = b""
+            if mode[0] == "r":
+                # Open the file only once, so that pipes and FIFOs are not
+                # consumed by the detection
+                raw = open(filename, "rb")
+                header = raw.peek(6)[:6]
+            compression = detect_compression(filename, header)
+
+        if compression:
+            if raw is None:
+                raw = open(filename, mode[0] + "b")
+            fh = _compressed_stream(raw, mode, compression, **kwargs)
+        elif raw is None:
+            fh = open(filename, mode, *args, **kwargs)
+        elif "b" in mode:
+            fh = raw
+        else:
+            fh = io.TextIOWrapper(raw, **kwargs)
         close = True
 
     try:
@@ -63,6 +197,8 @@ def smart_open(
                 fh.close()
             except AttributeError:
                 pass
+        if filename != "-" and raw is not None:
+            raw.close()
 
 
 def fetch_stream_data(input_source: str, encoding: str = "auto") -> str:
@@ -70,8 +206,9 @@ def fetch_stream_data(input_source: str, encoding: str = "auto") -> str:
     Read the input data as a string.
 
     The function takes care of handling input from both stdin and
-    files, decoding the stream of bytes according to the user-specified
-    character encoding (including automatic detection if necessary).
+    files, decompressing them if necessary, and decoding the stream of bytes
+    according to the user-specified character encoding (including automatic
+    detection if necessary).
 
     @param input_source: The input source file; "-", as handled by
         `smart_open()`, indicates stdin/stdout.
@@ -124,42 +261,102 @@ def slug_grapheme_label(grapheme: str) -> str:
     # Run a bunch of replacements for ASCII characters not accepted
     # by some of the tools (e.g., SplitsTree); we still try to
     # make the labels understandable for phonologists and reversible
-    replacements = {
-        "?": "_GS_",  # glottal stop
-        "`": "_AP_",
-        "@": "_AT_",
-        ":": "_LG_",
-        "~": "_TD_",
-        "\\": "_SL_",
-    }
-    for source, target in replacements.items():
+    for source, target in SLUG_REPLACEMENTS.items():
         slug_label = slug_label.replace(source, target)
 
     return slug_label
 
 
-def chars2corr(char_data):
+def unslug_labels(labels) -> list:
+    """
+    Decode labels built by `slug_grapheme_label()` back to IPA graphemes.
+
+    Labels can be either slugs (e.g., "_GS_") or NEXUS character state
+    labels (e.g., "c12_2__GS_"), whose character prefix is dropped. The
+    slug replacements are undone in a single pass of a precompiled pattern
+    and X-SAMPA is converted back to IPA, including after the "TONE_"
+    prefix (e.g., "TONE_1" for "ɨ") and after the LingPy irregularity
+    marker "!", which is kept. As the transliteration to ASCII is lossy,
+    graphemes with no X-SAMPA equivalent (such as superscript tone numbers)
+    might not be recovered.
+
+    @param labels: An iterable of labels.
+    @return: A list with the IPA grapheme of each label, with "-" for the
+        gaps (i.e., "ZERO") and `None` for the ascertainment states.
+    """
+
+    decoded = {}
+    graphemes = []
+    for label in labels:
+        if label not in decoded:
+            slug_label = _CHARSTATE_PREFIX.sub("", label, count=1)
+            if slug_label == "ascertainment":
+                decoded[label] = None
+            elif slug_label == "ZERO":
+                decoded[label] = "-"
+            else:
+                slug_label = _UNSLUG_PATTERN.sub(
+                    lambda match: _UNSLUG_MAP[match.group(0)], slug_label
+                )
+                # The irregularity marker is left untouched by the encoder,
+                # which only adds the tone prefix to labels starting with a
+                # digit; the X-SAMPA "!" (downstep) is only found alone
+                marker = ""
+                if slug_label.startswith("!") and len(slug_label) > 1:
+                    marker, slug_label = "!", slug_label[1:]
+                if slug_label == "-":
+                    decoded[label] = marker + slug_label
+                else:
+                    if slug_label.startswith(_TONE_PREFIX):
+                        slug_label = slug_label[len(_TONE_PREFIX) :]
+                    decoded[label] = marker + ipa.xsampa2ipa(slug_label)
+
+        graphemes.append(decoded[label])
+
+    return graphemes
+
+
+def pattern2char(label: str) -> str:
+    """
+    Return the name of the correspondence character for a pattern label.
+
+    @param label: The pattern label, as in the `PATTERNS` column of chars
+        data (e.g., "12-2/ʔ"), with or without the reflex after the slash.
+    @return: The name of the character (e.g., "c12_2").
+    """
+
+    return f'c{label.split("/")[0].replace("-", "_")}'
+
+
+def chars2corr(char_data, sparse: bool = False):
     """
     Builds a correspondence data structure from a chars one.
 
     @param char_data:
+    @param sparse: Whether to return the correspondences as a sparse
+        pattern × doculect `CorrMatrix` instead of a list of rows. Defaults
+        to `False`.
     @return:
     """
 
     # Collect character values for each correspodence pattern
     lang_obs = defaultdict(list)
     pat_values = defaultdict(list)
-    for row in char_data:
-        for pattern, value in zip(row["PATTERNS"].split(), row["ALIGNMENT"].split()):
-            # Skip over morphological markers
-            if value == "+":
-                continue
-
-            # `pattern_idx` == 0 is used for singletons
-            pattern_idx, _ = pattern.split("/")
-            if pattern_idx != "0":
-                lang_obs[row["DOCULECT"], pattern_idx].append(value)
-                pat_values[pattern_idx].append(value)
+    with stage("correspondences", "rows") as progress:
+        for row in char_data:
+            for pattern, value in zip(
+                row["PATTERNS"].split(), row["ALIGNMENT"].split()
+            ):
+                # Skip over morphological markers
+                if value == "+":
+                    continue
+
+                # `pattern_idx` == 0 is used for singletons
+                pattern_idx, _ = pattern.split("/")
+                if pattern_idx != "0":
+                    lang_obs[row["DOCULECT"], pattern_idx].append(value)
+                    pat_values[pattern_idx].append(value)
+            progress.advance()
 
     # Collect data for nexus/csv
     doculects = sorted(set([doculect for doculect, _ in list(lang_obs)]))
@@ -180,11 +377,16 @@ def chars2corr(char_data):
                     data.append(
                         {
                             "DOCULECT": doculect,
-                            "CHAR": f'c{pattern.replace("-", "_")}',
+                            "CHAR": pattern2char(pattern),
                             "PHONEME": ref_phon,
                         }
                     )
 
+    if sparse:
+        return CorrMatrix.from_triples(
+            (row["CHAR"], row["DOCULECT"], row["PHONEME"]) for row in data
+        )
+
     # Sort the data and return
     corr_data = sorted(data, key=lambda r: (r["CHAR"], r["DOCULECT"]))
 
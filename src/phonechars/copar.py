@@ -2,83 +2,179 @@
 Wrapper to use CoPAR to extract the characters.
 """
 
-# TODO: explore how to make it fully reproductible (set random seeds?)
-
 # Import Python standard libraries
 import logging
 import csv
-from collections import Counter
+from collections import Counter, OrderedDict
 import io
+import multiprocessing
+import random
 from tempfile import NamedTemporaryFile
+import time
 
 # Import 3rd-party libraries
 import lingpy
+from lingpy import basictypes
+from lingpy.sequence.sound_classes import tokens2class
 from lingrex.copar import CoPaR
 from lingrex.util import add_structure as lingrex_add_structure
 
-# TODO: make these arguments and not globals
-SEGMENTS_FIELD = "SEGMENTS"
-CONCEPT_FIELD = "CONCEPT"
+# Import local modules
+from .events import stage
 
+# Default names of the columns in the source data; "ipa" and "segments" are
+# optional, being derived from the alignment if missing
+DEFAULT_COLUMNS = {
+    "id": "ID",
+    "doculect": "DOCULECT",
+    "concept": "CONCEPT",
+    "ipa": "IPA",
+    "segments": "SEGMENTS",
+    "alignment": "ALIGNMENT",
+    "cogid": "COGID",
+}
 
-def build_lingpy_matrix(
-    source: str,
-    delimiter: str,
-    noid: bool = False,
+# Minimum number of rows for annotating the prosodic structure in parallel;
+# for smaller wordlists, the overhead of the pool outweighs the annotation
+PARALLEL_STRUCTURE_MIN_ROWS = 50000
+
+
+def _field_value(record: dict, column: str, required: bool = True) -> str:
+    """
+    Return the value of a field as a string, with an empty one if missing.
+
+    Lists (such as segments in data frames) are joined with spaces, and null
+    values (including NaNs) are treated as missing. A `KeyError` is raised
+    if a required column is not in the record.
+    """
+
+    if required:
+        value = record[column]
+    else:
+        value = record.get(column)
+    if value is None or value != value:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return " ".join(str(token) for token in value)
+
+    return str(value)
+
+
+def record2entry(record: dict, columns: dict) -> list:
+    """
+    Build an entry from a record, as stored by `records2entries()`.
+
+    @param record: A dictionary with the fields of a row.
+    @param columns: A dictionary mapping the keys of `DEFAULT_COLUMNS` to the
+        column names in the record.
+    @return: A list with doculect, concept, IPA, segments, cognate set, and
+        tokenized alignment.
+    """
+
+    alignment = _field_value(record, columns["alignment"])
+
+    # Grab SEGMENTS and IPA if not available in the source
+    segments = _field_value(record, columns["segments"], False)
+    if not segments:
+        segments = alignment.replace("-", "").strip()
+
+    ipa = _field_value(record, columns["ipa"], False)
+    if not ipa:
+        ipa = segments.replace(" ", "")
+
+    return [
+        _field_value(record, columns["doculect"]),
+        _field_value(record, columns["concept"]),
+        ipa,
+        segments,
+        _field_value(record, columns["cogid"]),
+        alignment.split(),
+    ]
+
+
+def records2entries(records, columns: dict = None, noid: bool = False) -> dict:
+    """
+    Build a dictionary of entries, keyed by their IDs, from a sequence of records.
+
+    @param records: An iterable of dictionaries, one per row.
+    @param columns: A dictionary mapping the keys of `DEFAULT_COLUMNS` to the
+        column names in the records, overriding the default ones.
+    @param noid: Whether to use a simple sequential index instead of the ID
+        field from the original file. Defaults to `False`.
+    @return: A dictionary from entry IDs to lists with doculect, concept, IPA,
+        segments, cognate set, and tokenized alignment, in the original
+        order.
+    """
+
+    columns = {**DEFAULT_COLUMNS, **(columns or {})}
+
+    entries = {}
+    with stage("load", "rows") as progress:
+        for idx, entry in enumerate(records):
+            if noid:
+                entry_id = idx + 1
+            else:
+                entry_id = int(entry[columns["id"]])
+
+            entries[entry_id] = record2entry(entry, columns)
+            progress.advance()
+
+    return entries
+
+
+def read_wordlist_entries(
+    source: str, delimiter: str, noid: bool = False, columns: dict = None
 ) -> dict:
     """
-    Read a tabular file and build a LingPy matrix from it, as expected by CoPAR.
+    Read a tabular source into a dictionary of entries, keyed by their IDs.
 
-    @param filename: Path to the source tabular file.
-    @param noid: Whether to use the ID field from the original file or a simple
-        sequential index. It is recommended to set to `False`, as in some cases
-        lingpy and its ecosystem require purely numerical IDs. Defaults to
-        `False`.
-    @return:
+    @param source: The tabular source data, as a string.
+    @param delimiter: The delimiter of the source, either "comma" or "tab".
+    @param noid: Whether to use a simple sequential index instead of the ID
+        field from the original file. Defaults to `False`.
+    @param columns: A dictionary overriding the default column names, as in
+        `records2entries()`.
+    @return: A dictionary of entries, as returned by `records2entries()`.
     """
 
-    # Read data and build a dictionary of row indexes to rows, as expected; index 0
-    # is the header, so we just skip it here
     delimiter_map = {"comma": ",", "tab": "\t"}
-    wordlist = {}
-    for idx, entry in enumerate(
-        csv.DictReader(io.StringIO(source), delimiter=delimiter_map[delimiter])
-    ):
-        if noid:
-            entry_id = idx + 1
-        else:
-            entry_id = int(entry["ID"])
-
-        # Grab SEGMENTS and IPA if not available in the source
-        segments = entry.get(SEGMENTS_FIELD)
-        if not segments:
-            segments = entry["ALIGNMENT"].replace("-", "").strip()
-
-        ipa = entry.get("IPA")
-        if not ipa:
-            ipa = segments.replace(" ", "")
-
-        wordlist[entry_id] = [
-            entry["DOCULECT"],
-            entry[CONCEPT_FIELD],
-            ipa,
-            segments,
-            entry["COGID"],
-            entry["ALIGNMENT"].split(),
-        ]
+    records = csv.DictReader(io.StringIO(source), delimiter=delimiter_map[delimiter])
+
+    return records2entries(records, columns, noid)
+
+
+def entries2matrix(entries: dict, cogsets: dict = None) -> dict:
+    """
+    Build a LingPy matrix from a dictionary of entries.
+
+    Entries whose cognate set has a single member are dropped, and the
+    remaining ones are reindexed sequentially (1-based) in their original
+    order. Cognate sets are remapped to the 1-based position of their first
+    occurrence in `entries`.
+
+    @param entries: A dictionary of entries, as returned by
+        `read_wordlist_entries()`.
+    @param cogsets: A dictionary from cognate sets to the IDs of their
+        entries, in order of first occurrence, as built by `index_records()`;
+        if not provided, it is computed from `entries`.
+    @return: The LingPy matrix, with the header at index 0.
+    """
 
     # Drop entries with a single lemma per cogid (fifth item in the structure, thus [4] -- it is
     # the way lingpy works)
-    cogid_count = Counter([entry[4] for _, entry in wordlist.items()])
-    entries = [entry for entry in wordlist.values() if cogid_count[entry[4]] > 1]
-    wordlist = {idx + 1: entry for idx, entry in enumerate(entries)}
+    if cogsets is None:
+        cogid_count = Counter([entry[4] for _, entry in entries.items()])
+    else:
+        cogid_count = {cogid: len(entry_ids) for cogid, entry_ids in cogsets.items()}
+    rows = [list(entry) for entry in entries.values() if cogid_count[entry[4]] > 1]
+    wordlist = {idx + 1: entry for idx, entry in enumerate(rows)}
 
     # Remap all "cogid" fields to the index in the list of cogids (1-based), as we need
     # to address 1. lingpy's requirement for purely numerical indexes and 2. lingrex
     # errors when the cogid is zero
-    cogid_map = list(cogid_count.keys())
+    cogid_map = {cogid: idx + 1 for idx, cogid in enumerate(cogid_count)}
     for row in wordlist.values():
-        row[4] = str(cogid_map.index(row[4]) + 1)
+        row[4] = str(cogid_map[row[4]])
 
     # Index 0 must hold the header
     wordlist[0] = ["doculect", "concept", "ipa", "tokens", "cogid", "alignment"]
@@ -86,7 +182,175 @@ def build_lingpy_matrix(
     return wordlist
 
 
-def get_copar_results(wordlist, refcol):
+def build_lingpy_matrix(
+    source: str,
+    delimiter: str,
+    noid: bool = False,
+    columns: dict = None,
+):
+    """
+    Read a tabular file and build a LingPy matrix from it, as expected by CoPAR.
+
+    @param filename: Path to the source tabular file.
+    @param noid: Whether to use the ID field from the original file or a simple
+        sequential index. It is recommended to set to `False`, as in some cases
+        lingpy and its ecosystem require purely numerical IDs. Defaults to
+        `False`.
+    @param columns: A dictionary mapping the keys of `DEFAULT_COLUMNS` to the
+        column names in the source, overriding the default ones.
+    @return:
+    """
+
+    return entries2matrix(read_wordlist_entries(source, delimiter, noid, columns))
+
+
+def collapse_duplicate_rows(wordlist: dict):
+    """
+    Collapse rows with identical lexical data, cognate set, and alignment.
+
+    Variant entries (such as multiple identical forms for the same doculect)
+    inflate the number of rows that CoPAR has to process without contributing
+    any information, as CoPAR only considers the first alignment of each
+    doculect in a cognate set. Rows are only grouped when they also share
+    concept, IPA, and tokens, which are part of the output of each row, so
+    that every row can be restored from its representative. Only the first
+    row of each group is kept,
+    preserving the order of the remaining rows, so that the results are
+    unaffected. The collapsed matrix is passed to `get_copar_results()`
+    along with the expansion map.
+
+    @param wordlist: A LingPy matrix, as returned by `build_lingpy_matrix()`.
+    @return: A tuple with the collapsed LingPy matrix and the expansion map,
+        a dictionary from the index of each representative row in the
+        collapsed matrix to the list of the indexes of its group in the
+        original one; the multiplicity of a row is the length of its list.
+    """
+
+    groups = {}
+    for idx in sorted(idx for idx in wordlist if idx != 0):
+        row = wordlist[idx]
+        key = (row[0], row[1], row[2], row[3], row[4], tuple(row[5]))
+        groups.setdefault(key, []).append(idx)
+
+    # Rebuild the matrix with the representatives, keeping the original order
+    representatives = sorted(groups.values(), key=lambda group: group[0])
+    collapsed = {
+        new_idx + 1: wordlist[group[0]] for new_idx, group in enumerate(representatives)
+    }
+    collapsed[0] = wordlist[0]
+    expansion = {new_idx + 1: group for new_idx, group in enumerate(representatives)}
+
+    logging.info(
+        "Collapsed %i rows into %i unique alignments.",
+        len(wordlist) - 1,
+        len(collapsed) - 1,
+    )
+
+    return collapsed, expansion
+
+
+def expand_duplicate_rows(rows: list, expansion: dict) -> list:
+    """
+    Re-expand CoPAR results to all the rows collapsed by `collapse_duplicate_rows()`.
+
+    Each collapsed row receives the output row of its representative, with
+    its own index; as rows are only collapsed when they share all their
+    lexical data, cognate set, and alignment, the rest of the row is the
+    same.
+
+    @param rows: The list of dictionaries with the results, as read back
+        from CoPAR.
+    @param expansion: The expansion map returned by
+        `collapse_duplicate_rows()`.
+    @return: The list of dictionaries with the results for all original rows.
+    """
+
+    expanded = []
+    for row in rows:
+        for idx in expansion[int(row["ID"])]:
+            expanded.append({**row, "ID": str(idx)})
+
+    return expanded
+
+
+def _structure_shard(rows: list):
+    """
+    Annotate the "cv" prosodic structure of a shard of rows.
+
+    The annotation is the same as the one of `lingrex_add_structure()` with
+    `model="cv"`.
+
+    @param rows: A list of `(idx, tokens)` tuples.
+    @return: A tuple with a dictionary from row indexes to their structures
+        and the time, in seconds, spent annotating them.
+    """
+
+    start = time.perf_counter()
+    structures = {
+        idx: " ".join(tokens2class(tokens, "cv")).lower() for idx, tokens in rows
+    }
+
+    return structures, time.perf_counter() - start
+
+
+def add_structure_parallel(alms, processes: int = None, shards: int = None):
+    """
+    Annotate the prosodic structure of an `Alignments` object in parallel.
+
+    Rows are split into shards annotated by a pool of worker processes, and
+    the results are merged back into the "structure" column, matching those
+    of `lingrex_add_structure(alms, model="cv", structure="structure")`.
+
+    @param alms: The `lingpy.Alignments` object.
+    @param processes: The number of worker processes; if `None`, the number
+        of CPUs is used.
+    @param shards: The number of shards; if `None`, four per process are
+        used, so that the work is balanced.
+    @return: The total time, in seconds, spent annotating the shards, i.e.,
+        the time of the annotation in a single process, with no pool.
+    """
+
+    # Tokens are sent as plain lists, as lingpy's types cannot be unpickled
+    rows = [(idx, list(tokens)) for idx, tokens in alms.iter_rows("tokens")]
+    processes = processes or multiprocessing.cpu_count()
+    shards = max(1, min(len(rows), shards or processes * 4))
+    size = -(-len(rows) // shards)
+
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(
+            _structure_shard,
+            [rows[idx : idx + size] for idx in range(0, len(rows), size)],
+        )
+
+    structures, elapsed = {}, 0.0
+    for shard_structures, shard_elapsed in results:
+        structures.update(shard_structures)
+        elapsed += shard_elapsed
+    alms.add_entries("structure", structures, basictypes.strings)
+
+    return elapsed
+
+
+def shuffle_sites(copar, seed: int):
+    """
+    Shuffle the order of the alignment sites of a CoPAR object.
+
+    The clustering of sites is greedy and breaks ties by the order of the
+    sites, which follows the cognate sets; a seeded shuffle yields another
+    valid, reproducible clustering, as used for replicates.
+
+    @param copar: The CoPAR object, after `get_sites()`.
+    @param seed: The seed for the random number generator.
+    """
+
+    sites = list(copar.sites.items())
+    random.Random(seed).shuffle(sites)
+    copar.sites = OrderedDict(sites)
+
+
+def get_copar_results(
+    wordlist, refcol, expansion=None, processes: int = 1, seed: int = None
+):
     """
     Encapsulate CoPAR to run detection.
 
@@ -97,19 +361,124 @@ def get_copar_results(wordlist, refcol):
 
     @param wordlist:
     @param refcol:
+    @param expansion: The expansion map for a collapsed wordlist, as returned
+        by `collapse_duplicate_rows()`. If provided, the
+        results are re-expanded to all the original rows.
+    @param processes: The number of worker processes for annotating the
+        prosodic structure, as in `prepare_copar()`.
+    @param seed: The seed for shuffling the order of the sites before
+        clustering (see `shuffle_sites()`). Results are reproducible for the
+        same data and seed; if `None`, the default, sites are clustered in
+        the order of the cognate sets.
     @return:
     """
 
-    # Run CoPAR
+    copar = copar_analysis(wordlist, refcol, processes, seed)
+    new_lines = read_copar_rows(copar)
+
+    # Re-expand collapsed rows, if any
+    if expansion:
+        new_lines = expand_duplicate_rows(new_lines, expansion)
+
+    # Sort values for reproducibility
+    new_lines = sorted(new_lines, key=lambda r: (int(r["COGID"]), int(r["ID"])))
+
+    return new_lines
+
+
+def prepare_copar(wordlist, refcol, processes: int = 1):
+    """
+    Build the CoPAR object for a wordlist, annotating the prosodic structure.
+
+    @param wordlist: A LingPy matrix, as returned by `build_lingpy_matrix()`.
+    @param refcol: The column with the cognate set references.
+    @param processes: The number of worker processes for annotating the
+        prosodic structure; if `1`, the default, or if the wordlist has less
+        than `PARALLEL_STRUCTURE_MIN_ROWS` rows, it is annotated in the
+        current process.
+    @return: The CoPAR object, with no analysis run.
+    """
+
     # TODO: study CoPAR arguments, might need to pin the lingrex version
     alms = lingpy.Alignments(wordlist, ref=refcol, transcription="ipa")
-    lingrex_add_structure(alms, model="cv", structure="structure")
+
+    # The pool only pays off for large wordlists, so that small ones are
+    # always annotated in the current process
+    start = time.perf_counter()
+    if processes == 1 or len(wordlist) - 1 < PARALLEL_STRUCTURE_MIN_ROWS:
+        lingrex_add_structure(alms, model="cv", structure="structure")
+        logging.info(
+            "Annotated the structure of %i rows in %.2fs.",
+            len(wordlist) - 1,
+            time.perf_counter() - start,
+        )
+    else:
+        # The shards are timed in the workers, so that their total is the
+        # time of the serial annotation, to be compared with the wall time
+        # including the overhead of the pool
+        serial = add_structure_parallel(alms, processes)
+        elapsed = time.perf_counter() - start
+        logging.info(
+            "Annotated the structure of %i rows in %.2fs with %i processes "
+            "(serial annotation: %.2fs, saved: %.2fs).",
+            len(wordlist) - 1,
+            elapsed,
+            processes or multiprocessing.cpu_count(),
+            serial,
+            serial - elapsed,
+        )
+
     copar = CoPaR(alms, ref=refcol, structure="structure", minrefs=2)
-    copar.get_sites()
-    copar.cluster_sites()
-    copar.sites_to_pattern()
-    copar.add_patterns()
-    copar.irregular_patterns()
+
+    return copar
+
+
+def copar_analysis(wordlist, refcol, processes: int = 1, seed: int = None):
+    """
+    Run the full CoPAR analysis on a wordlist.
+
+    @param wordlist: A LingPy matrix, as returned by `build_lingpy_matrix()`.
+    @param refcol: The column with the cognate set references.
+    @param processes: The number of worker processes for annotating the
+        prosodic structure, as in `prepare_copar()`.
+    @param seed: The seed for shuffling the order of the sites, if any, as
+        in `shuffle_sites()`.
+    @return: The CoPAR object, with sites clustered and patterns assigned.
+    """
+
+    with stage("structure", "rows") as progress:
+        copar = prepare_copar(wordlist, refcol, processes)
+        progress.set_count(len(wordlist) - 1)
+
+    with stage("sites", "sites") as progress:
+        copar.get_sites()
+        if seed is not None:
+            shuffle_sites(copar, seed)
+        progress.set_count(len(copar.sites))
+
+    # Sites start in one cluster per position and pattern, which CoPAR merges
+    with stage("clusters", "clusters") as progress:
+        initial = len(set(tuple(site) for site in copar.sites.values()))
+        copar.cluster_sites()
+        progress.set_count(len(copar.clusters))
+        progress.info["merged"] = initial - len(copar.clusters)
+
+    with stage("patterns", "patterns") as progress:
+        copar.sites_to_pattern()
+        copar.add_patterns()
+        copar.irregular_patterns()
+        progress.set_count(len(copar.patterns))
+
+    return copar
+
+
+def read_copar_rows(copar) -> list:
+    """
+    Export the results of a CoPAR analysis as a list of dictionaries.
+
+    @param copar: The CoPAR object, as returned by `copar_analysis()`.
+    @return: A list of dictionaries, one per row, in the order of the output.
+    """
 
     # Output to a temporary file, so that we can read back and
     # remove blank lines and comments introduced by lingpy/lingrex; note that
@@ -123,7 +492,9 @@ def get_copar_results(wordlist, refcol):
     # Read back data
     new_lines = []
     headers = None
-    with open(f"{output_file}.tsv", encoding="utf-8") as handler:
+    with stage("export", "rows") as progress, open(
+        f"{output_file}.tsv", encoding="utf-8"
+    ) as handler:
         for line in handler.readlines():
             line = line.strip()
             if line and line[0] != "#":
@@ -134,8 +505,6 @@ def get_copar_results(wordlist, refcol):
                     new_lines.append(
                         {key: value for key, value in zip(headers, tokens)}
                     )
-
-    # Sort values for reproducibility
-    new_lines = sorted(new_lines, key=lambda r: (int(r["COGID"]), int(r["ID"])))
+                    progress.advance()
 
     return new_lines
@@ -0,0 +1,188 @@
+"""
+Module for reporting the progress of long runs through events.
+
+Listeners are callables registered with `add_listener()`, receiving each
+event as a dictionary with at least the `event` type ("stage_start",
+"progress", "stage_end", or "stage_error"), the name of the `stage`, and a
+`time` timestamp. The other events also carry the `count` of items processed
+in the stage (e.g., rows loaded or sites collected), their `unit`, the
+`elapsed` time in seconds, and the throughput `rate` in items per second,
+along with any stage-specific fields (e.g., the number of clusters
+`merged`). When no listener is registered, the overhead is negligible.
+
+Note that events emitted in worker processes (e.g., by `run_subsets()`) are
+not delivered to the listeners of the main process.
+"""
+
+# Import Python standard libraries
+import contextlib
+import json
+import time
+import typing
+
+# Minimum interval, in seconds, between two progress events of a stage
+PROGRESS_INTERVAL = 1.0
+
+# The registered listeners
+_LISTENERS = []
+
+
+def add_listener(callback: typing.Callable[[dict], None]):
+    """
+    Register a listener, called with every event.
+
+    @param callback: A callable receiving the event as a dictionary.
+    """
+
+    if callback not in _LISTENERS:
+        _LISTENERS.append(callback)
+
+
+def remove_listener(callback: typing.Callable[[dict], None]):
+    """
+    Unregister a listener, if registered.
+
+    @param callback: The callable passed to `add_listener()`.
+    """
+
+    if callback in _LISTENERS:
+        _LISTENERS.remove(callback)
+
+
+def emit(event: str, stage_name: str, **data):
+    """
+    Send an event to all registered listeners.
+
+    @param event: The type of the event.
+    @param stage_name: The name of the stage the event refers to.
+    @param data: Additional fields for the event.
+    """
+
+    if not _LISTENERS:
+        return
+
+    record = {"event": event, "stage": stage_name, "time": time.time(), **data}
+    for callback in list(_LISTENERS):
+        callback(record)
+
+
+class StageProgress:
+    """
+    Progress counter of a stage, as yielded by `stage()`.
+    """
+
+    def __init__(self, name: str, unit: str, total: typing.Optional[int]):
+        self.name = name
+        self.unit = unit
+        self.total = total
+        self.count = 0
+        self.info = {}
+        self.start = time.perf_counter()
+        self._last = self.start
+
+    def _fields(self) -> dict:
+        """
+        Return the counting fields shared by progress and stage-end events.
+        """
+
+        elapsed = time.perf_counter() - self.start
+        fields = {
+            "count": self.count,
+            "unit": self.unit,
+            "elapsed": round(elapsed, 6),
+            "rate": round(self.count / elapsed, 3) if elapsed else None,
+        }
+        if self.total is not None:
+            fields["total"] = self.total
+        fields.update(self.info)
+
+        return fields
+
+    def advance(self, count: int = 1):
+        """
+        Add to the count of processed items, emitting a progress event if
+        `PROGRESS_INTERVAL` has passed since the last one.
+
+        @param count: The number of items processed since the last call.
+        """
+
+        self.count += count
+        if _LISTENERS:
+            now = time.perf_counter()
+            if now - self._last >= PROGRESS_INTERVAL:
+                self._last = now
+                emit("progress", self.name, **self._fields())
+
+    def set_count(self, count: int):
+        """
+        Set the count of processed items, for stages only counted at the end.
+
+        @param count: The total number of items processed.
+        """
+
+        self.count = count
+
+
+@contextlib.contextmanager
+def stage(name: str, unit: str = "items", total: typing.Optional[int] = None):
+    """
+    Context manager for a stage of the pipeline, emitting its start and end.
+
+    If an exception is raised within the stage, a "stage_error" event with
+    the error message is emitted instead of the "stage_end" one.
+
+    @param name: The name of the stage (e.g., "load" or "sites").
+    @param unit: The unit of the items counted in the stage (e.g., "rows").
+    @param total: The total number of items to process, if known in advance.
+    @return: The `StageProgress` object for counting processed items.
+    """
+
+    progress = StageProgress(name, unit, total)
+    emit("stage_start", name, unit=unit, **({} if total is None else {"total": total}))
+    try:
+        yield progress
+    except Exception as exc:
+        emit("stage_error", name, error=str(exc), **progress._fields())
+        raise
+    emit("stage_end", name, **progress._fields())
+
+
+def json_lines_listener(handler) -> typing.Callable[[dict], None]:
+    """
+    Build a listener writing each event as a line of JSON.
+
+    @param handler: The text stream to write to; it is flushed after every
+        event, so that it can be followed by external monitoring tools.
+    @return: The listener, to be passed to `add_listener()`.
+    """
+
+    def listener(record: dict):
+        handler.write(json.dumps(record, ensure_ascii=False) + "\n")
+        handler.flush()
+
+    return listener
+
+
+def format_event(record: dict) -> str:
+    """
+    Format an event as a human-readable line.
+
+    @param record: The event, as passed to the listeners.
+    @return: The formatted line.
+    """
+
+    if record["event"] == "stage_start":
+        return f"[{record['stage']}] started"
+
+    count = f"{record['count']}"
+    if "total" in record:
+        count += f"/{record['total']}"
+    line = f"[{record['stage']}] {count} {record['unit']} in {record['elapsed']:.1f}s"
+    if record["rate"] is not None:
+        line += f" ({record['rate']:.1f} {record['unit']}/s)"
+    if record["event"] == "stage_end":
+        line += ", done"
+    elif record["event"] == "stage_error":
+        line += f", failed: {record['error']}"
+
+    return line
@@ -0,0 +1,114 @@
+"""
+Module with functions for exporting the character matrix in other formats.
+
+All writers take an open text stream and the character matrix, as returned
+by `nexus.corrdata2matrix()`, writing the output taxon by taxon, so that the
+same matrix can be exported to several formats with no additional parsing.
+"""
+
+# Import Python standard libraries
+from xml.sax.saxutils import quoteattr
+
+# Import local modules
+from .nexus import nexus_chunks
+
+
+def _phylo_label(taxon: str) -> str:
+    """
+    Return a taxon label with no whitespace, as required by PHYLIP and FASTA.
+    """
+
+    return "_".join(taxon.split())
+
+
+def write_nexus(handler, taxa, charstates, assumptions, all_chars, matrix):
+    """
+    Write the character matrix in NEXUS format.
+
+    @param handler: The text stream to write to.
+    @param taxa: The list of taxa.
+    @param charstates: The list of character state labels.
+    @param assumptions: The list of character sets, for ascertainment.
+    @param all_chars: The dictionary of characters to their states.
+    @param matrix: The dictionary of taxa to their binary sequences.
+    """
+
+    handler.writelines(nexus_chunks(taxa, charstates, assumptions, all_chars, matrix))
+
+
+def write_phylip(handler, taxa, charstates, assumptions, all_chars, matrix):
+    """
+    Write the character matrix in relaxed PHYLIP format, as used by RAxML-NG.
+
+    @param handler: The text stream to write to.
+    @param taxa: The list of taxa.
+    @param charstates: The list of character state labels (unused).
+    @param assumptions: The list of character sets (unused).
+    @param all_chars: The dictionary of characters to their states (unused).
+    @param matrix: The dictionary of taxa to their binary sequences.
+    """
+
+    handler.write("%i %i\n" % (len(taxa), len(matrix[taxa[0]])))
+    taxon_len = max([len(_phylo_label(taxon)) for taxon in taxa])
+    for taxon in taxa:
+        handler.write("%s %s\n" % (_phylo_label(taxon).ljust(taxon_len), matrix[taxon]))
+
+
+def write_fasta(handler, taxa, charstates, assumptions, all_chars, matrix):
+    """
+    Write the character matrix as a binary FASTA alignment.
+
+    @param handler: The text stream to write to.
+    @param taxa: The list of taxa.
+    @param charstates: The list of character state labels (unused).
+    @param assumptions: The list of character sets (unused).
+    @param all_chars: The dictionary of characters to their states (unused).
+    @param matrix: The dictionary of taxa to their binary sequences.
+    """
+
+    for taxon in taxa:
+        handler.write(">%s\n%s\n" % (_phylo_label(taxon), matrix[taxon]))
+
+
+def write_beast_xml(
+    handler, taxa, charstates, assumptions, all_chars, matrix, data_id="phonechars"
+):
+    """
+    Write the character matrix as a BEAST2 XML data block.
+
+    Each character set is also written as a `FilteredAlignment` excluding its
+    first (all-zero) column, so that it can be used with an ascertainment
+    correction.
+
+    @param handler: The text stream to write to.
+    @param taxa: The list of taxa.
+    @param charstates: The list of character state labels (unused).
+    @param assumptions: The list of character sets, for ascertainment.
+    @param all_chars: The dictionary of characters to their states (unused).
+    @param matrix: The dictionary of taxa to their binary sequences.
+    @param data_id: The ID of the alignment in the XML.
+    """
+
+    handler.write('<data id=%s dataType="binary">\n' % quoteattr(data_id))
+    for taxon in taxa:
+        handler.write(
+            '\t<sequence id=%s spec="Sequence" taxon=%s totalcount="2" value="%s"/>\n'
+            % (quoteattr(f"seq_{taxon}"), quoteattr(taxon), matrix[taxon])
+        )
+    handler.write("</data>\n")
+
+    for char, start, end in assumptions:
+        handler.write(
+            '<data id=%s spec="FilteredAlignment" filter="%i-%i" data=%s '
+            'ascertained="true" excludefrom="0" excludeto="1"/>\n'
+            % (quoteattr(f"{data_id}_{char}"), start, end, quoteattr(f"@{data_id}"))
+        )
+
+
+# Writers and default filename extensions for each output format
+WRITERS = {
+    "nexus": (write_nexus, ".nex"),
+    "phylip": (write_phylip, ".phy"),
+    "fasta": (write_fasta, ".fasta"),
+    "beast": (write_beast_xml, ".xml"),
+}
@@ -0,0 +1,433 @@
+"""
+Module for incremental updates of CoPAR results.
+
+A full CoPAR run clusters all the alignment sites of a wordlist at once, which
+is expensive for large databases. When only a few rows are added or changed,
+the state of a previous run can be updated by recomputing the sites of the
+affected cognate sets alone and assigning them, greedily, to the existing
+correspondence patterns (or to new ones, when no compatible pattern is
+found). As the assignment does not revisit the clustering of the remaining
+sites, the results can differ from those of a full run, which should still
+be performed periodically.
+"""
+
+# Import Python standard libraries
+from collections import Counter, defaultdict
+import json
+import logging
+
+# Import 3rd-party libraries
+from lingrex.copar import compatible_columns
+
+# Import local modules
+from .common import chars2corr, pattern2char, smart_open
+from .copar import (
+    copar_analysis,
+    entries2matrix,
+    prepare_copar,
+    read_copar_rows,
+    read_wordlist_entries,
+)
+from .output import atomic_open
+from .validate import WordlistIndex
+
+# The symbol used by CoPAR for missing data
+MISSING = "Ø"
+
+
+def _source_entries(source, delimiter: str) -> tuple:
+    """
+    Return the entries of a source and their cognate sets, if indexed.
+
+    @param source: The tabular source data, as a string, or its
+        `WordlistIndex`, as returned by `index_wordlist()`.
+    @param delimiter: The delimiter of a string source.
+    @return: A tuple with the dictionary of entries, as returned by
+        `read_wordlist_entries()`, and the dictionary of cognate sets of the
+        index, or `None` for string sources.
+    """
+
+    if isinstance(source, WordlistIndex):
+        return source.entries, source.cogsets
+
+    return read_wordlist_entries(source, delimiter), None
+
+
+def _kept_entries(entries: dict, cogsets: dict = None) -> list:
+    """
+    Return the IDs of the entries kept by `entries2matrix()`, in matrix order.
+
+    @param entries: A dictionary of entries, as returned by
+        `read_wordlist_entries()`.
+    @param cogsets: The dictionary of cognate sets of the entries, as in
+        `entries2matrix()`; if not provided, it is computed from `entries`.
+    @return: A list of entry IDs, where the position (1-based) is the index
+        of the entry in the LingPy matrix.
+    """
+
+    if cogsets is None:
+        cogid_count = Counter([entry[4] for entry in entries.values()])
+    else:
+        cogid_count = {cogid: len(entry_ids) for cogid, entry_ids in cogsets.items()}
+    return [
+        entry_id for entry_id, entry in entries.items() if cogid_count[entry[4]] > 1
+    ]
+
+
+def build_copar_state(source, delimiter: str, refcol: str = "cogid") -> dict:
+    """
+    Run a full CoPAR analysis and return its state for incremental updates.
+
+    @param source: The tabular source data, as a string, or its
+        `WordlistIndex`, whose entries are used with no further parsing.
+    @param delimiter: The delimiter of the source, either "comma" or "tab";
+        ignored for indexes.
+    @param refcol: The column with the cognate set references.
+    @return: A dictionary with the state of the run, holding the source
+        entries (`entries`), the map of entry IDs and cognate sets to the ones
+        in the results (`ids` and `cogids`), the result rows (`chars`), the
+        correspondence patterns (`patterns`), and the pattern of each site
+        (`sites`).
+    """
+
+    entries, cogsets = _source_entries(source, delimiter)
+    kept = _kept_entries(entries, cogsets)
+    copar = copar_analysis(entries2matrix(entries, cogsets), refcol)
+
+    state = {
+        "entries": entries,
+        "ids": {},
+        "cogids": {},
+        "chars": {},
+        "patterns": {},
+        "sites": defaultdict(dict),
+        "last_pattern": 0,
+    }
+
+    cogid_labels = {}
+    for row in read_copar_rows(copar):
+        entry_id = kept[int(row["ID"]) - 1]
+        state["ids"][entry_id] = int(row["ID"])
+        state["cogids"][entries[entry_id][4]] = int(row["COGID"])
+        state["chars"][entry_id] = row
+        cogid_labels[int(row["COGID"])] = row["PATTERNS"].split()
+
+    # Collect the patterns from the clusters, identifying them by the labels
+    # assigned to their sites
+    for (slot, pattern), sites in copar.clusters.items():
+        cogid, position = sites[0]
+        label = cogid_labels[cogid][position]
+        pattern_idx = int(label.split("-")[0])
+        state["patterns"][pattern_idx] = {
+            "label": label,
+            "slot": slot,
+            "reflexes": {
+                doculect: reflex
+                for doculect, reflex in zip(copar.cols, pattern)
+                if reflex != MISSING
+            },
+            "size": len(sites),
+        }
+        for cogid, position in sites:
+            state["sites"][cogid][position] = pattern_idx
+
+    state["sites"] = dict(state["sites"])
+    state["last_pattern"] = max(state["patterns"], default=0)
+
+    return state
+
+
+def _assign_site(
+    state: dict, slot: str, site: dict, proto: str, previous: int = None
+) -> int:
+    """
+    Assign a site to the best compatible pattern, creating one if necessary.
+
+    As in CoPAR, a site is compatible with a pattern in the same prosodic slot
+    if there are no mismatches and at least one match. The pattern previously
+    assigned to the site is kept if still compatible; otherwise, the pattern
+    with most matches (and, in case of ties, the largest one) is selected.
+
+    @param state: The state of the run, which is updated in place.
+    @param slot: The prosodic slot of the site.
+    @param site: A dictionary from doculects to reflexes.
+    @param proto: The reflex used in the label of a new pattern.
+    @param previous: The index of the pattern previously assigned to the
+        site, if any.
+    @return: The index of the pattern assigned to the site.
+    """
+
+    best, best_score = None, None
+    for pattern_idx, pattern in state["patterns"].items():
+        if pattern["slot"] != slot:
+            continue
+
+        doculects = sorted(set(site) | set(pattern["reflexes"]))
+        match, mismatch = compatible_columns(
+            [site.get(doculect, MISSING) for doculect in doculects],
+            [pattern["reflexes"].get(doculect, MISSING) for doculect in doculects],
+        )
+        if mismatch == 0 and match >= 1:
+            score = (pattern_idx == previous, match, pattern["size"])
+            if best_score is None or score > best_score:
+                best, best_score = pattern_idx, score
+
+    if best is None:
+        state["last_pattern"] += 1
+        best = state["last_pattern"]
+        state["patterns"][best] = {
+            "label": f"{best}-1/{proto}",
+            "slot": slot,
+            "reflexes": {},
+            "size": 0,
+        }
+
+    # Extend the consensus with the reflexes of the site
+    pattern = state["patterns"][best]
+    for doculect, reflex in site.items():
+        pattern["reflexes"].setdefault(doculect, reflex)
+    pattern["size"] += 1
+
+    return best
+
+
+def _corr_by_char(char_rows: list, char_names: set) -> dict:
+    """
+    Collect the correspondences of a set of characters.
+
+    @param char_rows: A list of char rows.
+    @param char_names: The names of the characters to collect.
+    @return: A dictionary from character names to the set of
+        `(doculect, phoneme)` pairs.
+    """
+
+    corrs = defaultdict(set)
+    for row in chars2corr(char_rows):
+        if row["CHAR"] in char_names:
+            corrs[row["CHAR"]].add((row["DOCULECT"], row["PHONEME"]))
+
+    return corrs
+
+
+def update_copar_state(
+    state: dict, source, delimiter: str, refcol: str = "cogid"
+) -> dict:
+    """
+    Update the state of a CoPAR run with new or changed rows.
+
+    Rows in `source` with an ID already in the state replace the previous
+    ones. Only the cognate sets with new or changed rows are analyzed again,
+    with their sites assigned to the existing patterns; the labels of existing
+    patterns are never changed, so that character names are stable.
+
+    @param state: The state of a run, as returned by `build_copar_state()`,
+        which is updated in place.
+    @param source: The tabular source data with the new or changed rows, as
+        a string or as its `WordlistIndex`.
+    @param delimiter: The delimiter of the source, either "comma" or "tab";
+        ignored for indexes.
+    @param refcol: The column with the cognate set references.
+    @return: A dictionary with the lists of the names of the correspondence
+        characters that were `added`, `removed`, or `changed`.
+    """
+
+    entries = state["entries"]
+    old_chars = dict(state["chars"])
+
+    # Update the entries, collecting the affected cognate sets (both the new
+    # and the previous one of each entry)
+    delta, _ = _source_entries(source, delimiter)
+    affected = set()
+    for entry_id, entry in delta.items():
+        if entry_id in entries:
+            affected.add(entries[entry_id][4])
+        affected.add(entry[4])
+        entries[entry_id] = entry
+
+    # Drop the results for the affected cognate sets; patterns left empty are
+    # only removed after the new sites are assigned, so that they can be reused
+    touched = set()
+    previous = {}
+    for cogid in affected:
+        positions = state["sites"].pop(state["cogids"].get(cogid), {})
+        for position, pattern_idx in positions.items():
+            previous[cogid, position] = pattern_idx
+            touched.add(pattern_idx)
+            state["patterns"][pattern_idx]["size"] -= 1
+    for entry_id, entry in entries.items():
+        if entry[4] in affected or entry_id in delta:
+            state["chars"].pop(entry_id, None)
+
+    # Run CoPAR up to the collection of sites for the affected cognate sets
+    kept = _kept_entries(
+        {entry_id: entry for entry_id, entry in entries.items() if entry[4] in affected}
+    )
+    if kept:
+        copar = prepare_copar(
+            entries2matrix({entry_id: entries[entry_id] for entry_id in kept}),
+            refcol,
+        )
+        copar.get_sites()
+
+        sub_cogids = list(dict.fromkeys(entries[entry_id][4] for entry_id in kept))
+        for cogid in sub_cogids:
+            if cogid not in state["cogids"]:
+                state["cogids"][cogid] = max(state["cogids"].values(), default=0) + 1
+
+        labels = defaultdict(dict)
+        for (sub_cogid, position), (slot, reflexes) in sorted(copar.sites.items()):
+            site = {
+                doculect: reflex
+                for doculect, reflex in zip(copar.cols, reflexes)
+                if reflex != MISSING
+            }
+            pattern_idx = _assign_site(
+                state,
+                slot,
+                site,
+                reflexes[0],
+                previous.get((sub_cogids[sub_cogid - 1], position)),
+            )
+            cogid = state["cogids"][sub_cogids[sub_cogid - 1]]
+            state["sites"].setdefault(cogid, {})[position] = pattern_idx
+            labels[sub_cogid][position] = state["patterns"][pattern_idx]["label"]
+            touched.add(pattern_idx)
+
+        # Build the new result rows
+        for idx in copar:
+            entry_id = kept[idx - 1]
+            if entry_id not in state["ids"]:
+                state["ids"][entry_id] = max(state["ids"].values(), default=0) + 1
+            sub_cogid = int(copar[idx, refcol])
+            alignment = [str(token) for token in copar[idx, "alignment"]]
+            patterns = [
+                "+" if token == "+" else labels[sub_cogid].get(position, "0/n")
+                for position, token in enumerate(alignment)
+            ]
+            state["chars"][entry_id] = {
+                "ID": str(state["ids"][entry_id]),
+                "DOCULECT": copar[idx, "doculect"],
+                "CONCEPT": copar[idx, "concept"],
+                "IPA": str(copar[idx, "ipa"]),
+                "TOKENS": str(copar[idx, "tokens"]),
+                "COGID": str(state["cogids"][sub_cogids[sub_cogid - 1]]),
+                "ALIGNMENT": " ".join(alignment),
+                "STRUCTURE": str(copar[idx, "structure"]),
+                "PATTERNS": " ".join(patterns),
+            }
+
+    for pattern_idx in touched:
+        if state["patterns"][pattern_idx]["size"] == 0:
+            del state["patterns"][pattern_idx]
+
+    # Compare the correspondences of the touched patterns; note that the
+    # labels of removed patterns are still available in the previous rows
+    touched_idxs = {str(pattern_idx) for pattern_idx in touched}
+    touched_labels = set()
+    for row in old_chars.values():
+        for label in row["PATTERNS"].split():
+            if label.split("-")[0] in touched_idxs:
+                touched_labels.add(label)
+    for pattern_idx in touched:
+        if pattern_idx in state["patterns"]:
+            touched_labels.add(state["patterns"][pattern_idx]["label"])
+    char_names = {pattern2char(label) for label in touched_labels}
+
+    def _touched_rows(chars):
+        return [
+            row
+            for row in chars.values()
+            if touched_labels.intersection(row["PATTERNS"].split())
+        ]
+
+    old_corrs = _corr_by_char(_touched_rows(old_chars), char_names)
+    new_corrs = _corr_by_char(_touched_rows(state["chars"]), char_names)
+    report = {
+        "added": sorted(set(new_corrs) - set(old_corrs)),
+        "removed": sorted(set(old_corrs) - set(new_corrs)),
+        "changed": sorted(
+            char
+            for char in set(old_corrs) & set(new_corrs)
+            if old_corrs[char] != new_corrs[char]
+        ),
+    }
+
+    logging.info(
+        "Updated %i cognate sets: %i characters added, %i removed, %i changed.",
+        len(affected),
+        len(report["added"]),
+        len(report["removed"]),
+        len(report["changed"]),
+    )
+
+    return report
+
+
+def state2chars(state: dict) -> list:
+    """
+    Return the result rows of a state, as returned by `get_copar_results()`.
+
+    @param state: The state of a run.
+    @return: A list of dictionaries with the results, sorted by cognate set
+        and ID.
+    """
+
+    return sorted(
+        state["chars"].values(), key=lambda r: (int(r["COGID"]), int(r["ID"]))
+    )
+
+
+def write_state(handler, state: dict):
+    """
+    Write the state of a run to an open text stream, as JSON.
+
+    @param handler: The stream to be written, such as one passed by
+        `OutputWriter.submit()`.
+    @param state: The state of a run.
+    """
+
+    json.dump(state, handler, ensure_ascii=False)
+
+
+def save_state(state: dict, filename: str):
+    """
+    Write the state of a run to disk, as JSON (compressed if the filename
+    has the extension of a compression format).
+
+    The file is replaced atomically, so that an interrupted run never leaves
+    a truncated state.
+
+    @param state: The state of a run.
+    @param filename: The path to the file to be written.
+    """
+
+    with atomic_open(filename) as handler:
+        write_state(handler, state)
+
+
+def load_state(filename: str) -> dict:
+    """
+    Read the state of a run from disk, as written by `save_state()`.
+
+    @param filename: The path to the file to be read.
+    @return: The state of the run.
+    """
+
+    with smart_open(filename, encoding="utf-8") as handler:
+        data = json.load(handler)
+
+    # JSON only allows string keys, so we need to restore the integer ones
+    state = {
+        "entries": {int(key): value for key, value in data["entries"].items()},
+        "ids": {int(key): value for key, value in data["ids"].items()},
+        "cogids": data["cogids"],
+        "chars": {int(key): value for key, value in data["chars"].items()},
+        "patterns": {int(key): value for key, value in data["patterns"].items()},
+        "sites": {
+            int(cogid): {int(pos): idx for pos, idx in positions.items()}
+            for cogid, positions in data["sites"].items()
+        },
+        "last_pattern": data["last_pattern"],
+    }
+
+    return state
@@ -1,16 +1,17 @@
 # Code from phonocodes
 # TODO: replace with maniphono
 
-import re
+from types import MappingProxyType
 
-_xsampa2ipa = {
-    k: re.sub(r"◌", "", v)
-    for (k, v) in {
+# X-SAMPA symbols and their IPA equivalents; combining diacritics are given
+# as escapes
+_xsampa2ipa = MappingProxyType(
+    {
         "#": "#",
-        "=": "◌̩",
-        ">": "◌ʼ",
-        "`": "◌˞",
-        "~": "◌̃",
+        "=": "\u0329",
+        ">": "ʼ",
+        "`": "˞",
+        "~": "\u0303",
         "a": "a",
         "b": "b",
         "b_<": "ɓ",
@@ -38,7 +39,7 @@ _xsampa2ipa = {
         "o": "o",
         "p": "p",
         "p\\": "ɸ",
-        "p_<": "ɓ̥",
+        "p_<": "ɓ\u0325",
         "q": "q",
         "r": "r",
         "r`": "ɽ",
@@ -72,7 +73,7 @@ _xsampa2ipa = {
         "H": "ɥ",
         "H\\": "ʜ",
         "I": "ɪ",
-        "I\\": "ɪ̈ ",
+        "I\\": "ɪ\u0308 ",
         "J": "ɲ",
         "J\\": "ɟ",
         "J\\_<": "ʄ",
@@ -94,7 +95,7 @@ _xsampa2ipa = {
         "S": "ʃ",
         "T": "θ",
         "U": "ʊ",
-        "U\\": "ʊ̈ ",
+        "U\\": "ʊ\u0308 ",
         "V": "ʌ",
         "W": "ʍ",
         "X": "χ",
@@ -138,84 +139,94 @@ _xsampa2ipa = {
         "|\\|\\": "ǁ",
         "=\\": "ǂ",
         "-\\": "‿",
-    }.items()
-}
+    }
+)
 
-_xsampa_vowels = set("aeiouyAEIOUYQV@123}{6789&") | set(("I\\", "U\\", "@\\", "3\\"))
+_xsampa_vowels = frozenset("aeiouyAEIOUYQV@123}{6789&") | frozenset(
+    ("I\\", "U\\", "@\\", "3\\")
+)
 
-_xdiacritics2ipa = {
-    k: re.sub(r"◌", "", v)
-    for (k, v) in {
-        '"': "◌̈",
-        "+": "◌̟",
-        "-": "◌̠",
-        "/": "◌̌",
-        "0": "◌̥",
-        "=": "◌̩",
-        ">": "◌ʼ",
-        "?\\": "◌ˤ",
-        "\\": "◌̂",
-        "^": "◌̯",
-        "}": "◌̚",
-        "`": "◌˞",
-        "~": "◌̃",
-        "A": "◌̘",
-        "a": "◌̺",
-        "B": "◌̏",
-        "B_L": "◌᷅",
-        "c": "◌̜",
-        "d": "◌̪",
-        "e": "◌̴",
-        "F": "◌̂",
-        "G": "◌ˠ",
-        "H": "◌́",
-        "H_T": "◌᷄",
-        "h": "◌ʰ",
-        "j": "◌ʲ",
-        "k": "◌̰",
-        "L": "◌̀",
-        "l": "◌ˡ",
-        "M": "◌̄",
-        "m": "◌̻",
-        "N": "◌̼",
-        "n": "◌ⁿ",
-        "O": "◌̹",
-        "o": "◌̞",
-        "q": "◌̙",
-        "R": "◌̌",
-        "R_F": "◌᷈",
-        "r": "◌̝",
-        "T": "◌̋",
-        "t": "◌̤",
-        "v": "◌̬",
-        "w": "◌ʷ",
-        "X": "◌̆",
-        "x": "◌̽",
+# X-SAMPA diacritics (without the leading underscore) and their IPA
+# equivalents
+_xdiacritics2ipa = MappingProxyType(
+    {
+        '"': "\u0308",
+        "+": "\u031f",
+        "-": "\u0320",
+        "/": "\u030c",
+        "0": "\u0325",
+        "=": "\u0329",
+        ">": "ʼ",
+        "?\\": "ˤ",
+        "\\": "\u0302",
+        "^": "\u032f",
+        "}": "\u031a",
+        "`": "˞",
+        "~": "\u0303",
+        "A": "\u0318",
+        "a": "\u033a",
+        "B": "\u030f",
+        "B_L": "\u1dc5",
+        "c": "\u031c",
+        "d": "\u032a",
+        "e": "\u0334",
+        "F": "\u0302",
+        "G": "ˠ",
+        "H": "\u0301",
+        "H_T": "\u1dc4",
+        "h": "ʰ",
+        "j": "ʲ",
+        "k": "\u0330",
+        "L": "\u0300",
+        "l": "ˡ",
+        "M": "\u0304",
+        "m": "\u033b",
+        "N": "\u033c",
+        "n": "ⁿ",
+        "O": "\u0339",
+        "o": "\u031e",
+        "q": "\u0319",
+        "R": "\u030c",
+        "R_F": "\u1dc8",
+        "r": "\u031d",
+        "T": "\u030b",
+        "t": "\u0324",
+        "v": "\u032c",
+        "w": "ʷ",
+        "X": "\u0306",
+        "x": "\u033d",
         "1": "˥",
         "2": "˦",
         "3": "˧",
         "4": "˨",
         "5": "˩",
-    }.items()
-}
+    }
+)
 
 # Create and _xsampa2ipa with '_'+k for each diacritic
-_xsampa_and_diac2ipa = _xsampa2ipa.copy()
-_xsampa_and_diac2ipa.update({("_" + k): v for (k, v) in _xdiacritics2ipa.items()})
+_xsampa_and_diac2ipa = MappingProxyType(
+    {**_xsampa2ipa, **{("_" + k): v for (k, v) in _xdiacritics2ipa.items()}}
+)
 
-_ipa2xsampa = {v: k for (k, v) in _xsampa_and_diac2ipa.items()}
+_ipa2xsampa = MappingProxyType({v: k for (k, v) in _xsampa_and_diac2ipa.items()})
 
+# Maximum symbol lengths of the tables, so they are not computed at each call
+_ipa2xsampa_maxsym = max(len(k) for k in _ipa2xsampa)
+_xsampa_and_diac2ipa_maxsym = max(len(k) for k in _xsampa_and_diac2ipa)
 
-def translate_string(s, d):
+
+def translate_string(s, d, maxsym=None):
     """(tl,ttf)=translate_string(s,d):
     Translate the string, s, using symbols from dict, d, as:
     1. Min # untranslatable symbols, then 2. Min # symbols.
     tl = list of translated or untranslated symbols.
-    ttf[n] = True if tl[n] was translated, else ttf[n]=False."""
+    ttf[n] = True if tl[n] was translated, else ttf[n]=False.
+    maxsym = max input symbol length of d, computed if not given."""
     N = len(s)
     symcost = 1  # path cost per translated symbol
     oovcost = 10  # path cost per untranslatable symbol
-    maxsym = max(len(k) for k in d.keys())  # max input symbol length
+    if maxsym is None:
+        maxsym = max(len(k) for k in d.keys())  # max input symbol length
     # (pathcost to s[(n-m):n], n-m, translation[s[(n-m):m]], True/False)
     lattice = [(0, 0, "", True)]
     for n in range(1, N + 1):
@@ -243,5 +254,11 @@ def translate_string(s, d):
 
 def ipa2xsampa(x, language):
     """Attempt to return X-SAMPA equivalent of an IPA phone x."""
-    (tl, ttf) = translate_string(x, _ipa2xsampa)
+    (tl, ttf) = translate_string(x, _ipa2xsampa, _ipa2xsampa_maxsym)
+    return "".join(tl)
+
+
+def xsampa2ipa(x):
+    """Attempt to return IPA equivalent of an X-SAMPA phone x."""
+    (tl, ttf) = translate_string(x, _xsampa_and_diac2ipa, _xsampa_and_diac2ipa_maxsym)
     return "".join(tl)
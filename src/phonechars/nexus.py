@@ -7,6 +7,10 @@ from collections import defaultdict
 import csv
 import logging
 
+# Import local modules
+from .events import stage
+from .sparse import CorrMatrix
+
 
 def parse_corr_data(data, taxa):
     """
@@ -63,16 +67,19 @@ def parse_corr_data(data, taxa):
     return charstates, assumptions, all_chars, matrix
 
 
-def build_nexus_string(taxa, charstates, assumptions, all_chars, matrix):
+def nexus_chunks(taxa, charstates, assumptions, all_chars, matrix):
     """
-    Build the NEXUS string from the parsed information.
+    Generate the NEXUS source from the parsed information, piece by piece.
+
+    The rows of the matrix are generated one at a time, so that the source
+    can be written without holding it in memory.
 
     @param taxa:
     @param charstates:
     @param assumptions:
     @param all_chars:
     @param matrix:
-    @return:
+    @return: A generator of strings, whose concatenation is the NEXUS source.
     """
 
     taxon_len = max([len(taxon) for taxon in taxa])
@@ -88,19 +95,62 @@ def build_nexus_string(taxa, charstates, assumptions, all_chars, matrix):
     )
     nexus += "\n;\n"
     nexus += "MATRIX\n"
+    yield nexus
+
     for taxon, vector in matrix.items():
         label = taxon.ljust(taxon_len + 4)
-        nexus += "%s %s\n" % (label, vector)
+        yield "%s %s\n" % (label, vector)
+
+    nexus = ""
     nexus += ";\n"
     nexus += "END;\n\n"
 
     nexus += "BEGIN ASSUMPTIONS;\n"
     for assump in assumptions:
-        v = all_chars[assump[0]][0].split("_")[0]
         nexus += "\tcharset %s = %i-%i;\n" % (assump[0], assump[1], assump[2])
     nexus += "END;\n\n"
+    yield nexus
 
-    return nexus
+
+def build_nexus_string(taxa, charstates, assumptions, all_chars, matrix):
+    """
+    Build the NEXUS string from the parsed information.
+
+    @param taxa:
+    @param charstates:
+    @param assumptions:
+    @param all_chars:
+    @param matrix:
+    @return:
+    """
+
+    return "".join(nexus_chunks(taxa, charstates, assumptions, all_chars, matrix))
+
+
+def corrdata2matrix(corr_data):
+    """
+    Build the character matrix from correspondence data.
+
+    @param corr_data: The list of correspondences, as returned by
+        `chars2corr()`, or a sparse `CorrMatrix`.
+    @return: A tuple with the list of taxa and the structures returned by
+        `parse_corr_data()`, as expected by `build_nexus_string()` and the
+        writers in the `formats` module.
+    """
+
+    with stage("matrix", "characters") as progress:
+        if isinstance(corr_data, CorrMatrix):
+            taxa, charstates, assumptions, all_chars, matrix = (
+                corr_data.to_nexus_matrix()
+            )
+        else:
+            taxa = sorted(set([row["DOCULECT"] for row in corr_data]))
+            charstates, assumptions, all_chars, matrix = parse_corr_data(
+                corr_data, taxa
+            )
+        progress.set_count(len(all_chars))
+
+    return taxa, charstates, assumptions, all_chars, matrix
 
 
 # TODO: allow output to stdout?
@@ -116,8 +166,7 @@ def corrdata2nexus(corr_data):
     """
 
     # Get information from correlation data data
-    taxa = sorted(set([row["DOCULECT"] for row in corr_data]))
-    charstates, assumptions, all_chars, matrix = parse_corr_data(corr_data, taxa)
+    taxa, charstates, assumptions, all_chars, matrix = corrdata2matrix(corr_data)
 
     # Build and return the NEXUS string
     nexus = build_nexus_string(taxa, charstates, assumptions, all_chars, matrix)
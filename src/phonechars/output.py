@@ -0,0 +1,307 @@
+"""
+Module for writing output files atomically, in background threads.
+
+Each output is written to a temporary file in the directory of its target,
+which is only renamed to the target once complete, so that other processes
+never see truncated outputs. `OutputWriter` serializes several outputs
+concurrently, committing all of them only if all succeed and recording a
+manifest with the size and checksum of each file, written last.
+"""
+
+# Import Python standard libraries
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import stat
+import tempfile
+import threading
+import typing
+
+# Import local modules
+from .common import detect_compression, smart_open
+from .events import stage
+
+# Size of the buffer for uncompressed outputs and for computing checksums
+BUFFER_SIZE = 1024 * 1024
+
+# Lock for reading the umask, which can only be done by setting it
+_UMASK_LOCK = threading.Lock()
+
+
+def _temp_name(filename: Path) -> str:
+    """
+    Create a temporary file next to a target file and return its name.
+    """
+
+    handler, temp_name = tempfile.mkstemp(
+        dir=filename.parent, prefix=f".{filename.name}.", suffix=".tmp"
+    )
+    os.close(handler)
+
+    return temp_name
+
+
+def _stream_options(
+    filename: Path, compression: typing.Optional[str], encoding: str
+) -> tuple:
+    """
+    Return the compression and the arguments for `smart_open()` of an output.
+    """
+
+    if compression == "auto":
+        compression = detect_compression(filename)
+    kwargs = {"encoding": encoding}
+    if not compression:
+        kwargs["buffering"] = BUFFER_SIZE
+
+    return compression, kwargs
+
+
+def _set_mode(temp_name: str, filename: Path):
+    """
+    Set the permissions of a temporary file to those of its target.
+
+    Temporary files are created readable only by their owner, so they are
+    given the mode of the existing target or, for new targets, the default
+    mode of new files under the current umask, as with `open()`.
+    """
+
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        with _UMASK_LOCK:
+            umask = os.umask(0)
+            os.umask(umask)
+        mode = 0o666 & ~umask
+
+    os.chmod(temp_name, mode)
+
+
+def _sync(filename: str):
+    """
+    Flush a written file to disk, so that it is complete once renamed.
+    """
+
+    with open(filename, "rb+") as handler:
+        os.fsync(handler.fileno())
+
+
+def file_checksum(filename: str) -> typing.Tuple[str, int]:
+    """
+    Return the SHA-256 checksum and the size of a file.
+
+    @param filename: The path to the file.
+    @return: A tuple with the hexadecimal checksum and the size in bytes.
+    """
+
+    checksum = hashlib.sha256()
+    size = 0
+    with open(filename, "rb") as handler:
+        for block in iter(lambda: handler.read(BUFFER_SIZE), b""):
+            checksum.update(block)
+            size += len(block)
+
+    return checksum.hexdigest(), size
+
+
+@contextlib.contextmanager
+def atomic_open(
+    filename: str, compression: typing.Optional[str] = "auto", encoding="utf-8"
+):
+    """
+    Open a file for writing text atomically.
+
+    The stream writes to a temporary file, renamed to `filename` only when
+    the context is left with no errors, and removed otherwise.
+
+    @param filename: The path to the file.
+    @param compression: The compression format, as in `smart_open()`; if
+        "auto", it is detected from the extension of `filename`.
+    @param encoding: The text encoding. Defaults to "utf-8".
+    """
+
+    filename = Path(filename)
+    temp_name = _temp_name(filename)
+    try:
+        compression, kwargs = _stream_options(filename, compression, encoding)
+        with smart_open(temp_name, "w", compression=compression, **kwargs) as handler:
+            yield handler
+        _sync(temp_name)
+        _set_mode(temp_name, filename)
+        os.replace(temp_name, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_name)
+        raise
+
+
+def _write_temp(
+    filename: Path,
+    write: typing.Callable,
+    compression: typing.Optional[str],
+    encoding: str,
+):
+    """
+    Write an output to a temporary file, as run by `OutputWriter`.
+
+    @return: A tuple with the name of the temporary file, its checksum, and
+        its size.
+    """
+
+    temp_name = _temp_name(filename)
+    try:
+        compression, kwargs = _stream_options(filename, compression, encoding)
+        with smart_open(temp_name, "w", compression=compression, **kwargs) as handler:
+            write(handler)
+        _sync(temp_name)
+        _set_mode(temp_name, filename)
+        checksum, size = file_checksum(temp_name)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_name)
+        raise
+
+    return temp_name, checksum, size
+
+
+class OutputWriter:
+    """
+    Write several outputs concurrently, committing them atomically.
+
+    Outputs are submitted with a function writing to a text stream, run in
+    a background thread. When used as a context manager, all outputs are
+    committed when the context is left with no errors, and discarded
+    otherwise.
+    """
+
+    def __init__(self, manifest: typing.Optional[str] = None, max_workers: int = 4):
+        """
+        @param manifest: The path to the JSON manifest to be written after
+            committing the outputs, if any.
+        @param max_workers: The maximum number of writer threads.
+        """
+
+        self.manifest = Path(manifest) if manifest else None
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._futures = {}
+
+    def submit(
+        self,
+        filename: str,
+        write: typing.Callable,
+        compression: typing.Optional[str] = "auto",
+        encoding: str = "utf-8",
+    ):
+        """
+        Schedule the writing of an output.
+
+        @param filename: The path to the output file.
+        @param write: A function taking the text stream to write to.
+        @param compression: The compression format, as in `smart_open()`; if
+            "auto", it is detected from the extension of `filename`.
+        @param encoding: The text encoding. Defaults to "utf-8".
+        """
+
+        filename = Path(filename)
+        if filename in self._futures:
+            raise ValueError(f"Output `{filename}` was already submitted.")
+
+        logging.info("Writing `%s`...", filename)
+        self._futures[filename] = self._executor.submit(
+            _write_temp, filename, write, compression, encoding
+        )
+
+    def _wait(self) -> dict:
+        """
+        Wait for all outputs, removing the temporary files if any failed.
+        """
+
+        results, error = {}, None
+        for filename, future in self._futures.items():
+            try:
+                results[filename] = future.result()
+            except Exception as exc:
+                error = error or exc
+        self._executor.shutdown()
+
+        if error:
+            for temp_name, _, _ in results.values():
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp_name)
+            raise error
+
+        return results
+
+    def commit(self) -> dict:
+        """
+        Wait for all outputs, rename them to their targets, and write the
+        manifest.
+
+        @return: A dictionary from output paths to dictionaries with their
+            `sha256` checksum and `size`, as written in the manifest.
+        """
+
+        entries = {}
+        with stage("write", "files", total=len(self._futures)) as progress:
+            for filename, (temp_name, checksum, size) in self._wait().items():
+                os.replace(temp_name, filename)
+                entries[filename] = {"sha256": checksum, "size": size}
+                progress.advance()
+
+        if self.manifest:
+            base = self.manifest.parent
+            files = {
+                os.path.relpath(filename, base): entry
+                for filename, entry in entries.items()
+            }
+            with atomic_open(self.manifest, None) as handler:
+                json.dump({"files": files}, handler, ensure_ascii=False, indent=2)
+
+        return entries
+
+    def abort(self):
+        """
+        Wait for all outputs and discard them.
+        """
+
+        with contextlib.suppress(Exception):
+            for temp_name, _, _ in self._wait().values():
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.commit()
+
+
+def verify_manifest(manifest: str) -> list:
+    """
+    Check the files listed in a manifest against their sizes and checksums.
+
+    @param manifest: The path to the JSON manifest.
+    @return: A list with the paths of the files that are missing or do not
+        match the manifest; empty if all outputs are complete.
+    """
+
+    manifest = Path(manifest)
+    with open(manifest, encoding="utf-8") as handler:
+        files = json.load(handler)["files"]
+
+    failed = []
+    for path, entry in files.items():
+        filename = manifest.parent / path
+        if not filename.exists():
+            failed.append(path)
+        elif file_checksum(filename) != (entry["sha256"], entry["size"]):
+            failed.append(path)
+
+    return failed
@@ -0,0 +1,174 @@
+"""
+Module for running seeded replicates of the analysis and their consensus.
+
+The clustering of alignment sites by CoPAR is greedy, so that the order in
+which sites are visited can lead to different, equally valid, patterns.
+Replicates shuffle the sites with different seeds (see
+`copar.shuffle_sites()`) and are run in parallel, sharing the wordlist
+with the worker processes as in `run_subsets()`. Their patterns are mapped
+to those of a reference run, so that a consensus pattern and a stability
+score can be reported for each site.
+"""
+
+# Import Python standard libraries
+from collections import Counter, defaultdict
+import copy
+import logging
+import multiprocessing
+
+# Import local modules
+from .copar import get_copar_results
+
+# The wordlist and expansion map shared by the worker processes, set by
+# `_init_worker()`
+_WORDLIST = None
+_EXPANSION = None
+
+
+def site_patterns(char_data: list) -> dict:
+    """
+    Return the pattern assigned to each alignment site.
+
+    @param char_data: The list of char rows, as returned by
+        `get_copar_results()`.
+    @return: A dictionary from `(cogid, position)` tuples to the index of
+        their patterns (e.g., "12"), with "0" for singletons.
+    """
+
+    sites = {}
+    for row in char_data:
+        for position, label in enumerate(row["PATTERNS"].split()):
+            if label != "+":
+                pattern = label.split("/")[0].split("-")[0]
+                sites.setdefault((row["COGID"], position), pattern)
+
+    return sites
+
+
+def consensus_patterns(reference: dict, replicates: list) -> list:
+    """
+    Build the consensus of the patterns of several runs, with site stability.
+
+    The patterns of each replicate are mapped to the reference pattern with
+    which they share the most sites, and each site is given the pattern
+    with the most votes among the reference and the mapped replicates (with
+    ties broken in favor of the reference).
+
+    @param reference: The patterns of the reference run, as returned by
+        `site_patterns()`.
+    @param replicates: A list with the patterns of each replicate, as
+        returned by `site_patterns()`.
+    @return: A list of dictionaries with the `COGID` and `POSITION` of each
+        site, its consensus `PATTERN`, and its `STABILITY` (the share of
+        runs agreeing with the consensus), sorted by site.
+    """
+
+    votes = defaultdict(Counter)
+    for site, pattern in reference.items():
+        votes[site][pattern] += 1
+
+    for sites in replicates:
+        overlap = defaultdict(Counter)
+        for site, pattern in sites.items():
+            overlap[pattern][reference[site]] += 1
+
+        # Singletons are never mapped to a pattern
+        mapping = {
+            pattern: min(counts, key=lambda ref: (-counts[ref], int(ref)))
+            for pattern, counts in overlap.items()
+        }
+        mapping["0"] = "0"
+        for site, pattern in sites.items():
+            votes[site][mapping[pattern]] += 1
+
+    consensus = []
+    for cogid, position in sorted(reference, key=lambda s: (int(s[0]), s[1])):
+        pattern, count = votes[cogid, position].most_common(1)[0]
+        consensus.append(
+            {
+                "COGID": cogid,
+                "POSITION": position,
+                "PATTERN": pattern,
+                "STABILITY": round(count / (len(replicates) + 1), 3),
+            }
+        )
+
+    return consensus
+
+
+def _init_worker(wordlist: dict, expansion: dict):
+    """
+    Store the shared wordlist and expansion map in a worker process.
+    """
+
+    global _WORDLIST, _EXPANSION
+    _WORDLIST = wordlist
+    _EXPANSION = expansion
+
+
+def _run_replicate(seed):
+    """
+    Run the analysis on a copy of the shared wordlist with a given seed.
+
+    @param seed: The seed for shuffling the sites.
+    @return: The list of char rows, as returned by `get_copar_results()`.
+    """
+
+    logging.info("Running replicate with seed %s.", seed)
+
+    # lingpy changes the contents of the matrix in place, so we need a copy
+    return get_copar_results(copy.deepcopy(_WORDLIST), "cogid", _EXPANSION, seed=seed)
+
+
+def run_replicates(
+    wordlist: dict,
+    replicates: int,
+    seed: int = None,
+    expansion: dict = None,
+    processes: int = None,
+):
+    """
+    Run seeded replicates of the analysis in parallel, with their consensus.
+
+    @param wordlist: A LingPy matrix, as returned by `build_lingpy_matrix()`.
+    @param replicates: The number of replicates, besides the reference run.
+    @param seed: The seed of the reference run, as in `get_copar_results()`;
+        replicates use the following integers (starting from 1, if `None`).
+    @param expansion: The expansion map for a collapsed wordlist, as in
+        `get_copar_results()`.
+    @param processes: The number of worker processes; if `None`, the number
+        of CPUs is used, and if `1`, replicates are run in the current
+        process.
+    @return: A tuple with the char rows of the reference run, as returned by
+        `get_copar_results()`, and the consensus, as returned by
+        `consensus_patterns()`.
+    """
+
+    if replicates < 1:
+        raise ValueError("At least one replicate is required.")
+
+    seeds = [seed] + [(seed or 0) + idx + 1 for idx in range(replicates)]
+    if processes == 1:
+        _init_worker(wordlist, expansion)
+        results = [_run_replicate(task) for task in seeds]
+        _init_worker(None, None)
+    else:
+        with multiprocessing.Pool(
+            processes, initializer=_init_worker, initargs=(wordlist, expansion)
+        ) as pool:
+            results = pool.map(_run_replicate, seeds, chunksize=1)
+
+    reference = site_patterns(results[0])
+    consensus = consensus_patterns(
+        reference, [site_patterns(char_data) for char_data in results[1:]]
+    )
+
+    unstable = len([site for site in consensus if site["STABILITY"] < 1])
+    logging.info(
+        "Ran %i replicates; %i of %i sites are not stable.",
+        replicates,
+        unstable,
+        len(consensus),
+    )
+
+    return results[0], consensus
@@ -0,0 +1,395 @@
+"""
+Module with a sparse pattern × doculect representation of correspondences.
+
+Most correspondence patterns are only observed in a few doculects, so that
+the list of `(DOCULECT, CHAR, PHONEME)` rows returned by `chars2corr()` is
+better stored as a sparse matrix in CSR (compressed sparse row) layout:
+patterns are the rows and doculects the columns, both integer-coded, and
+phonemes are interned and stored as integer codes. Rows and columns can be
+sliced, patterns filtered by coverage, and the matrix converted to the
+structures used for NEXUS output and back to rows in time proportional to
+the number of stored entries; for slicing columns, a CSC (compressed sparse
+column) index is built on first use.
+"""
+
+# Import Python standard libraries
+from array import array
+from collections import defaultdict
+
+
+class CorrMatrix:
+    """
+    Sparse matrix of correspondences, with patterns as rows.
+
+    Entries of each row are stored in `indices` (the doculect codes) and
+    `data` (the phoneme codes), sorted by doculect and phoneme, from
+    `indptr[row]` to `indptr[row + 1]`; a doculect might have more than one
+    entry in a row if it has more than one phoneme for the pattern. The
+    entries of each column are indexed lazily by `column()`.
+    """
+
+    def __init__(
+        self,
+        patterns: list,
+        doculects: list,
+        phonemes: list,
+        indptr: array,
+        indices: array,
+        data: array,
+    ):
+        self.patterns = patterns
+        self.doculects = doculects
+        self.phonemes = phonemes
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+        self._pattern_idx = {pattern: idx for idx, pattern in enumerate(patterns)}
+        self._doculect_idx = {doculect: idx for idx, doculect in enumerate(doculects)}
+
+        # CSC index, with the rows and positions of the entries of each column
+        # from `_colptr[col]` to `_colptr[col + 1]`, built by `_build_csc()`
+        self._colptr = None
+        self._col_rows = None
+        self._col_pos = None
+
+    @classmethod
+    def from_triples(cls, triples):
+        """
+        Build a matrix from `(pattern, doculect, phoneme)` tuples.
+
+        @param triples: An iterable of tuples; duplicates are dropped.
+        @return: The `CorrMatrix`, with patterns and doculects sorted.
+        """
+
+        entries = sorted(set(triples))
+        patterns = sorted({pattern for pattern, _, _ in entries})
+        doculects = sorted({doculect for _, doculect, _ in entries})
+        phonemes = sorted({phoneme for _, _, phoneme in entries})
+
+        pattern_idx = {pattern: idx for idx, pattern in enumerate(patterns)}
+        doculect_idx = {doculect: idx for idx, doculect in enumerate(doculects)}
+        phoneme_idx = {phoneme: idx for idx, phoneme in enumerate(phonemes)}
+
+        # As codes follow the sorted labels, sorted entries are already in
+        # CSR order
+        indptr = array("l", [0] * (len(patterns) + 1))
+        indices, data = array("l"), array("l")
+        for pattern, doculect, phoneme in entries:
+            indptr[pattern_idx[pattern] + 1] += 1
+            indices.append(doculect_idx[doculect])
+            data.append(phoneme_idx[phoneme])
+        for idx in range(len(patterns)):
+            indptr[idx + 1] += indptr[idx]
+
+        return cls(patterns, doculects, phonemes, indptr, indices, data)
+
+    @classmethod
+    def from_rows(cls, corr_data):
+        """
+        Build a matrix from correspondence rows.
+
+        @param corr_data: An iterable of correspondences, as returned by
+            `chars2corr()` or read from a `.corrs.tsv` file.
+        @return: The `CorrMatrix`.
+        """
+
+        return cls.from_triples(
+            (row["CHAR"], row["DOCULECT"], row["PHONEME"]) for row in corr_data
+        )
+
+    @property
+    def shape(self) -> tuple:
+        """
+        The number of patterns and doculects.
+        """
+
+        return len(self.patterns), len(self.doculects)
+
+    @property
+    def nnz(self) -> int:
+        """
+        The number of stored entries.
+        """
+
+        return len(self.data)
+
+    def row(self, pattern: str) -> dict:
+        """
+        Return the phonemes of each doculect for a pattern.
+
+        @param pattern: The name of the pattern (e.g., "c12_2").
+        @return: A dictionary from doculects to lists of phonemes.
+        """
+
+        idx = self._pattern_idx[pattern]
+        values = defaultdict(list)
+        for pos in range(self.indptr[idx], self.indptr[idx + 1]):
+            values[self.doculects[self.indices[pos]]].append(
+                self.phonemes[self.data[pos]]
+            )
+
+        return dict(values)
+
+    def _build_csc(self):
+        """
+        Index the entries of each column, with a counting sort by doculect.
+        """
+
+        colptr = array("l", [0] * (len(self.doculects) + 1))
+        for code in self.indices:
+            colptr[code + 1] += 1
+        for code in range(len(self.doculects)):
+            colptr[code + 1] += colptr[code]
+
+        # Rows are visited in order, so that the entries of each column are
+        # sorted by row
+        fill = array("l", colptr[:-1])
+        col_rows = array("l", [0] * len(self.indices))
+        col_pos = array("l", [0] * len(self.indices))
+        for idx in range(len(self.patterns)):
+            for pos in range(self.indptr[idx], self.indptr[idx + 1]):
+                code = self.indices[pos]
+                col_rows[fill[code]] = idx
+                col_pos[fill[code]] = pos
+                fill[code] += 1
+
+        self._colptr, self._col_rows, self._col_pos = colptr, col_rows, col_pos
+
+    def column(self, doculect: str) -> dict:
+        """
+        Return the phonemes of a doculect for each pattern.
+
+        The CSC index is built on the first call, so that columns are sliced
+        in time proportional to their number of entries.
+
+        @param doculect: The name of the doculect.
+        @return: A dictionary from patterns to lists of phonemes.
+        """
+
+        if self._colptr is None:
+            self._build_csc()
+
+        code = self._doculect_idx[doculect]
+        values = defaultdict(list)
+        for col_idx in range(self._colptr[code], self._colptr[code + 1]):
+            values[self.patterns[self._col_rows[col_idx]]].append(
+                self.phonemes[self.data[self._col_pos[col_idx]]]
+            )
+
+        return dict(values)
+
+    def _subset(self, keep_row, keep_column=None):
+        """
+        Build a new matrix with the selected rows and columns.
+
+        All selected doculects are kept, even if left with no entries, so that
+        they are still output as taxa with missing data; phonemes left with no
+        entries are dropped. Codes are renumbered, keeping the original order.
+        """
+
+        kept = []
+        for idx, pattern in enumerate(self.patterns):
+            if keep_row(idx):
+                start, end = self.indptr[idx], self.indptr[idx + 1]
+                entries = [
+                    (self.indices[pos], self.data[pos])
+                    for pos in range(start, end)
+                    if keep_column is None or keep_column(self.indices[pos])
+                ]
+                if entries:
+                    kept.append((pattern, entries))
+
+        doculect_codes = [
+            code
+            for code in range(len(self.doculects))
+            if keep_column is None or keep_column(code)
+        ]
+        phoneme_codes = sorted({code for _, row in kept for _, code in row})
+        doculect_map = {code: idx for idx, code in enumerate(doculect_codes)}
+        phoneme_map = {code: idx for idx, code in enumerate(phoneme_codes)}
+
+        indptr, indices, data = array("l", [0]), array("l"), array("l")
+        for _, entries in kept:
+            for doculect_code, phoneme_code in entries:
+                indices.append(doculect_map[doculect_code])
+                data.append(phoneme_map[phoneme_code])
+            indptr.append(len(indices))
+
+        return CorrMatrix(
+            [pattern for pattern, _ in kept],
+            [self.doculects[code] for code in doculect_codes],
+            [self.phonemes[code] for code in phoneme_codes],
+            indptr,
+            indices,
+            data,
+        )
+
+    def select_patterns(self, patterns) -> "CorrMatrix":
+        """
+        Return a new matrix with a subset of the patterns (rows).
+
+        @param patterns: The names of the patterns to keep.
+        @return: The new `CorrMatrix`.
+        """
+
+        codes = {self._pattern_idx[pattern] for pattern in patterns}
+
+        return self._subset(lambda idx: idx in codes)
+
+    def select_doculects(self, doculects) -> "CorrMatrix":
+        """
+        Return a new matrix with a subset of the doculects (columns).
+
+        Patterns left with no entries are dropped.
+
+        @param doculects: The names of the doculects to keep.
+        @return: The new `CorrMatrix`.
+        """
+
+        codes = {self._doculect_idx[doculect] for doculect in doculects}
+
+        return self._subset(lambda idx: True, lambda code: code in codes)
+
+    def coverage(self) -> list:
+        """
+        Return the number of doculects observed in each pattern.
+
+        @return: A list with the coverage of each pattern, in order.
+        """
+
+        return [
+            len(set(self.indices[self.indptr[idx] : self.indptr[idx + 1]]))
+            for idx in range(len(self.patterns))
+        ]
+
+    def filter_coverage(self, min_doculects: int) -> "CorrMatrix":
+        """
+        Return a new matrix with the patterns observed in enough doculects.
+
+        @param min_doculects: The minimum number of doculects of a pattern.
+        @return: The new `CorrMatrix`.
+        """
+
+        coverage = self.coverage()
+
+        return self._subset(lambda idx: coverage[idx] >= min_doculects)
+
+    def prune(
+        self,
+        min_doculects: int = 1,
+        min_states: int = 1,
+        informative: bool = False,
+        max_states: int = None,
+    ):
+        """
+        Return a new matrix without the patterns failing the pruning rules.
+
+        Rules are checked in order, with each pruned pattern counted for the
+        first rule it fails, in a single pass over the stored entries.
+
+        @param min_doculects: The minimum number of doculects observed in a
+            pattern.
+        @param min_states: The minimum number of distinct states (phonemes)
+            of a pattern; `2` drops constant characters.
+        @param informative: Whether to drop patterns that are not parsimony
+            informative, i.e., with less than two states observed in two or
+            more doculects each. Defaults to `False`.
+        @param max_states: The maximum number of states of a pattern, if
+            any; patterns with more states are dropped.
+        @return: A tuple with the new `CorrMatrix` and a dictionary with the
+            number of patterns removed by each rule.
+        """
+
+        removed = {
+            "min_doculects": 0,
+            "min_states": 0,
+            "informative": 0,
+            "max_states": 0,
+        }
+        keep = set()
+        for idx in range(len(self.patterns)):
+            start, end = self.indptr[idx], self.indptr[idx + 1]
+            # The doculects observed with each state (phoneme code)
+            state_doculects = defaultdict(set)
+            for pos in range(start, end):
+                state_doculects[self.data[pos]].add(self.indices[pos])
+
+            if len(set(self.indices[start:end])) < min_doculects:
+                removed["min_doculects"] += 1
+            elif len(state_doculects) < min_states:
+                removed["min_states"] += 1
+            elif informative and (
+                len([codes for codes in state_doculects.values() if len(codes) > 1]) < 2
+            ):
+                removed["informative"] += 1
+            elif max_states is not None and len(state_doculects) > max_states:
+                removed["max_states"] += 1
+            else:
+                keep.add(idx)
+
+        return self._subset(lambda idx: idx in keep), removed
+
+    def to_rows(self) -> list:
+        """
+        Convert the matrix back to correspondence rows.
+
+        @return: The list of correspondences, sorted by pattern and doculect,
+            as returned by `chars2corr()`.
+        """
+
+        return [
+            {
+                "DOCULECT": self.doculects[self.indices[pos]],
+                "CHAR": pattern,
+                "PHONEME": self.phonemes[self.data[pos]],
+            }
+            for idx, pattern in enumerate(self.patterns)
+            for pos in range(self.indptr[idx], self.indptr[idx + 1])
+        ]
+
+    def to_nexus_matrix(self):
+        """
+        Build the character matrix for NEXUS output.
+
+        @return: A tuple with the list of taxa, the character states, the
+            assumptions, the states of each character, and the matrix, as
+            returned by `nexus.corrdata2matrix()`.
+        """
+
+        # Phoneme codes follow the sorted labels, so that the states of each
+        # pattern are the sorted set of its codes
+        charstates, assumptions, all_chars = [], [], {}
+        pieces = [[] for _ in self.doculects]
+        cur_idx = 1
+        for idx, pattern in enumerate(self.patterns):
+            start, end = self.indptr[idx], self.indptr[idx + 1]
+            codes = sorted(set(self.data[start:end]))
+            values = [self.phonemes[code] for code in codes]
+            all_chars[pattern] = values
+
+            charstates.append(f"{pattern}_ascertainment")
+            charstates += [f"{pattern}_{value}" for value in values]
+            end_idx = cur_idx + len(values)
+            assumptions.append([pattern, cur_idx, end_idx])
+            cur_idx = end_idx + 1
+
+            # Fill the states of the observed doculects, with missing data for
+            # the others
+            states = defaultdict(lambda: ["0"] * len(codes))
+            positions = {code: pos for pos, code in enumerate(codes)}
+            for pos in range(start, end):
+                states[self.indices[pos]][positions[self.data[pos]]] = "1"
+            missing = "0" + "?" * len(codes)
+            for code, taxon_pieces in enumerate(pieces):
+                if code in states:
+                    taxon_pieces.append("0" + "".join(states[code]))
+                else:
+                    taxon_pieces.append(missing)
+
+        matrix = {
+            doculect: "".join(pieces[code])
+            for code, doculect in enumerate(self.doculects)
+        }
+
+        return list(self.doculects), charstates, assumptions, all_chars, matrix
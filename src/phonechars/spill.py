@@ -0,0 +1,235 @@
+"""
+Module for building correspondences and matrices with bounded memory.
+
+`chars2corr()` and `nexus.parse_corr_data()` hold all observations and the
+full matrix in memory, which is not feasible for the largest datasets. The
+functions in this module produce the same results, but process the data in
+chunks of at most `max_memory` bytes (as estimated from the size of the
+Python objects): correspondence observations are sorted in chunks spilled to
+temporary files and merged externally, and the matrix is built one character
+block at a time, with the rows of each taxon spilled to disk and only
+assembled when requested.
+"""
+
+# Import Python standard libraries
+from collections import defaultdict
+from collections.abc import Mapping
+import csv
+import heapq
+import itertools
+from pathlib import Path
+import sys
+import tempfile
+import typing
+
+# Import local modules
+from .common import pattern2char, slug_grapheme_label
+from .events import stage
+
+# Estimated overhead, in bytes, of each spilled item held in memory (tuple or
+# list entry), besides the size of its strings
+ITEM_OVERHEAD = 64
+
+
+def _spill_chunk(chunk: list, directory: str) -> str:
+    """
+    Sort a chunk of observations and write it to a temporary file.
+
+    @param chunk: The list of `(char, doculect, order, value)` tuples.
+    @param directory: The directory for the temporary file.
+    @return: The path to the temporary file.
+    """
+
+    chunk.sort()
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, suffix=".tsv", delete=False, encoding="utf-8", newline=""
+    ) as handler:
+        csv.writer(handler, delimiter="\t").writerows(chunk)
+
+    return handler.name
+
+
+def _read_chunk(filename: str):
+    """
+    Read back the observations of a spilled chunk, in order.
+    """
+
+    with open(filename, encoding="utf-8", newline="") as handler:
+        for char, doculect, order, value in csv.reader(handler, delimiter="\t"):
+            yield char, doculect, int(order), value
+
+
+def chars2corr_spill(char_data, max_memory: int, tmpdir: str = None):
+    """
+    Build the correspondences from chars data, with bounded memory.
+
+    The results are the same as those of `chars2corr()`, but the char rows
+    can be consumed from a stream (such as a `csv.DictReader`) and the
+    correspondences are yielded one at a time.
+
+    @param char_data: An iterable of char rows, as returned by
+        `get_copar_results()` or read from a `.chars.tsv` file.
+    @param max_memory: The maximum size, in bytes, of the observations held
+        in memory before spilling them to disk.
+    @param tmpdir: The directory for the temporary files; if not provided,
+        the system default is used.
+    @return: A generator of correspondences, sorted by character and
+        doculect, as in `chars2corr()`.
+    """
+
+    with tempfile.TemporaryDirectory(dir=tmpdir) as directory:
+        chunk, chunk_bytes, chunk_files = [], 0, []
+        order = 0
+        with stage("correspondences", "rows") as progress:
+            for row in char_data:
+                for pattern, value in zip(
+                    row["PATTERNS"].split(), row["ALIGNMENT"].split()
+                ):
+                    # Skip over morphological markers and singletons, as in
+                    # `chars2corr()`
+                    if value == "+" or pattern.split("/")[0] == "0":
+                        continue
+
+                    item = (pattern2char(pattern), row["DOCULECT"], order, value)
+                    chunk.append(item)
+                    chunk_bytes += ITEM_OVERHEAD + sum(
+                        sys.getsizeof(field) for field in item
+                    )
+                    order += 1
+
+                if chunk_bytes > max_memory:
+                    chunk_files.append(_spill_chunk(chunk, directory))
+                    chunk, chunk_bytes = [], 0
+                progress.advance()
+
+            chunk.sort()
+            progress.info["chunks"] = len(chunk_files)
+
+        # Merge the sorted chunks, keeping the first observation (i.e., the one
+        # with the lowest order) for each character and doculect
+        merged = heapq.merge(chunk, *[_read_chunk(name) for name in chunk_files])
+        for (char, doculect), items in itertools.groupby(
+            merged, key=lambda item: item[:2]
+        ):
+            value = next(items)[3]
+            if value == "-":
+                phoneme = "ZERO"
+            else:
+                phoneme = slug_grapheme_label(value.split("/")[0])
+
+            yield {"DOCULECT": doculect, "CHAR": char, "PHONEME": phoneme}
+
+
+class SpilledMatrix(Mapping):
+    """
+    Read-only mapping of taxa to their binary sequences, stored on disk.
+
+    Each taxon has a file with a line for each character block where it has
+    observations, holding the index of the block and the states of the
+    taxon; sequences are assembled from it when requested, filling the
+    missing blocks.
+    """
+
+    def __init__(self, directory, taxon_files: dict, assumptions: list):
+        # Keep a reference to the `TemporaryDirectory`, so that the files are
+        # removed with the matrix
+        self._directory = directory
+        self._taxon_files = taxon_files
+        self._assumptions = assumptions
+
+    def __getitem__(self, taxon: str) -> str:
+        pieces = []
+        with open(self._taxon_files[taxon], encoding="utf-8") as handler:
+            blocks = (line.rstrip("\n").split("\t") for line in handler)
+            block = next(blocks, None)
+            for block_idx, (_, start, end) in enumerate(self._assumptions):
+                if block and int(block[0]) == block_idx:
+                    pieces.append("0" + block[1])
+                    block = next(blocks, None)
+                else:
+                    pieces.append("0" + "?" * (end - start))
+
+        return "".join(pieces)
+
+    def __iter__(self):
+        return iter(sorted(self._taxon_files))
+
+    def __len__(self) -> int:
+        return len(self._taxon_files)
+
+
+def _flush_blocks(buffers: dict, taxon_files: dict):
+    """
+    Append the buffered blocks to the file of each taxon.
+    """
+
+    for taxon, lines in buffers.items():
+        with open(taxon_files[taxon], "a", encoding="utf-8") as handler:
+            handler.writelines(lines)
+    buffers.clear()
+
+
+def corrdata2matrix_spill(
+    corr_data: typing.Iterable[dict], max_memory: int, tmpdir: str = None
+):
+    """
+    Build the character matrix from correspondence data, with bounded memory.
+
+    The results are the same as those of `nexus.corrdata2matrix()`, but the
+    correspondences are consumed from a stream, one character block at a
+    time, and the matrix is stored on disk.
+
+    @param corr_data: An iterable of correspondences, sorted by character,
+        as returned by `chars2corr()` or read from a `.corrs.tsv` file.
+    @param max_memory: The maximum size, in bytes, of the blocks held in
+        memory before spilling them to disk.
+    @param tmpdir: The directory for the temporary files; if not provided,
+        the system default is used.
+    @return: A tuple with the list of taxa, the character states, the
+        assumptions, the states of each character, and the matrix as a
+        `SpilledMatrix`, as returned by `nexus.corrdata2matrix()`.
+    """
+
+    directory = tempfile.TemporaryDirectory(dir=tmpdir)
+    taxon_files = {}
+    buffers, buffer_bytes = defaultdict(list), 0
+
+    charstates, assumptions, all_chars = [], [], {}
+    cur_idx = 1
+    with stage("matrix", "characters") as progress:
+        blocks = itertools.groupby(corr_data, key=lambda row: row["CHAR"])
+        for block_idx, (char, rows) in enumerate(blocks):
+            if char in all_chars:
+                raise ValueError("Correspondences must be sorted by character.")
+
+            lang_chars = defaultdict(set)
+            for row in rows:
+                lang_chars[row["DOCULECT"]].add(row["PHONEME"])
+            values = sorted(set().union(*lang_chars.values()))
+            all_chars[char] = values
+
+            # Build the character states and assumptions, with ascertainment,
+            # as in `parse_corr_data()`
+            charstates.append(f"{char}_ascertainment")
+            charstates += [f"{char}_{value}" for value in values]
+            end_idx = cur_idx + len(values)
+            assumptions.append([char, cur_idx, end_idx])
+            cur_idx = end_idx + 1
+
+            for taxon, phonemes in lang_chars.items():
+                if taxon not in taxon_files:
+                    taxon_files[taxon] = Path(directory.name) / f"{len(taxon_files)}"
+                states = "".join("1" if value in phonemes else "0" for value in values)
+                buffers[taxon].append(f"{block_idx}\t{states}\n")
+                buffer_bytes += ITEM_OVERHEAD + sys.getsizeof(states)
+
+            if buffer_bytes > max_memory:
+                _flush_blocks(buffers, taxon_files)
+                buffer_bytes = 0
+            progress.advance()
+
+        _flush_blocks(buffers, taxon_files)
+
+    matrix = SpilledMatrix(directory, taxon_files, assumptions)
+
+    return list(matrix), charstates, assumptions, all_chars, matrix
@@ -0,0 +1,291 @@
+"""
+Module for storing chars and correspondences in a SQLite database.
+
+The database holds normalized tables for doculects, cognate sets, patterns
+(i.e., correspondence characters), and phonemes, along with the forms (the
+rows of a `.chars.tsv` file), the alignment sites assigned to each pattern,
+and the correspondences (the rows of a `.corrs.tsv` file), indexed on the
+common lookup keys. Data can be loaded back into the structures used by
+`chars2corr()` and `corrdata2nexus()`.
+"""
+
+# Import Python standard libraries
+import contextlib
+import logging
+import sqlite3
+import typing
+
+# Import local modules
+from .common import chars2corr, pattern2char, slug_grapheme_label
+
+# Fields of the char rows, in the order of the `.chars.tsv` files
+CHAR_FIELDS = [
+    "ID",
+    "DOCULECT",
+    "CONCEPT",
+    "IPA",
+    "TOKENS",
+    "COGID",
+    "ALIGNMENT",
+    "STRUCTURE",
+    "PATTERNS",
+]
+
+SCHEMA = """
+CREATE TABLE doculects (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE cogsets (id INTEGER PRIMARY KEY, cogid TEXT UNIQUE NOT NULL);
+CREATE TABLE patterns (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    idx INTEGER NOT NULL
+);
+CREATE TABLE phonemes (id INTEGER PRIMARY KEY, label TEXT UNIQUE NOT NULL);
+CREATE TABLE forms (
+    id INTEGER PRIMARY KEY,
+    doculect_id INTEGER NOT NULL REFERENCES doculects(id),
+    cogset_id INTEGER NOT NULL REFERENCES cogsets(id),
+    concept TEXT,
+    ipa TEXT,
+    tokens TEXT,
+    alignment TEXT,
+    structure TEXT,
+    patterns TEXT
+);
+CREATE TABLE sites (
+    cogset_id INTEGER NOT NULL REFERENCES cogsets(id),
+    position INTEGER NOT NULL,
+    pattern_id INTEGER NOT NULL REFERENCES patterns(id),
+    PRIMARY KEY (cogset_id, position)
+);
+CREATE TABLE correspondences (
+    pattern_id INTEGER NOT NULL REFERENCES patterns(id),
+    doculect_id INTEGER NOT NULL REFERENCES doculects(id),
+    phoneme_id INTEGER NOT NULL REFERENCES phonemes(id),
+    PRIMARY KEY (pattern_id, doculect_id)
+);
+CREATE INDEX forms_cogset ON forms (cogset_id);
+CREATE INDEX forms_doculect ON forms (doculect_id);
+CREATE INDEX patterns_idx ON patterns (idx);
+CREATE INDEX sites_pattern ON sites (pattern_id);
+CREATE INDEX corrs_doculect_phoneme ON correspondences (doculect_id, phoneme_id);
+"""
+
+
+def _pattern_idx(pattern: str) -> int:
+    """
+    Return the index of a pattern from its name.
+
+    @param pattern: The name of the pattern, either in full (e.g., "c100_1"),
+        without the size (e.g., "c100"), or just the index (e.g., "100").
+    @return: The index of the pattern.
+    """
+
+    return int(pattern.lstrip("c").split("_")[0])
+
+
+def _get_id(cursor, table: str, column: str, value: str, cache: dict) -> int:
+    """
+    Return the primary key for a value in a lookup table, inserting if needed.
+    """
+
+    if value not in cache:
+        if table == "patterns":
+            cursor.execute(
+                "INSERT INTO patterns (name, idx) VALUES (?, ?)",
+                (value, _pattern_idx(value)),
+            )
+        else:
+            cursor.execute(f"INSERT INTO {table} ({column}) VALUES (?)", (value,))
+        cache[value] = cursor.lastrowid
+
+    return cache[value]
+
+
+def export_sqlite(
+    filename: str, char_data: list, corr_data: typing.Optional[list] = None
+):
+    """
+    Write chars and correspondences to a new SQLite database.
+
+    @param filename: The path to the database; any existing tables with the
+        same names are replaced.
+    @param char_data: The list of char rows, as returned by
+        `get_copar_results()`.
+    @param corr_data: The list of correspondences, as returned by
+        `chars2corr()`; if not provided, it is computed from `char_data`.
+    """
+
+    if corr_data is None:
+        corr_data = chars2corr(char_data)
+
+    with contextlib.closing(sqlite3.connect(filename)) as conn:
+        cursor = conn.cursor()
+        for table in [
+            "correspondences",
+            "sites",
+            "forms",
+            "phonemes",
+            "patterns",
+            "cogsets",
+            "doculects",
+        ]:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.executescript(SCHEMA)
+
+        doculects, cogsets, patterns, phonemes = {}, {}, {}, {}
+        for row in char_data:
+            doculect_id = _get_id(
+                cursor, "doculects", "name", row["DOCULECT"], doculects
+            )
+            cogset_id = _get_id(cursor, "cogsets", "cogid", row["COGID"], cogsets)
+            cursor.execute(
+                "INSERT INTO forms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    int(row["ID"]),
+                    doculect_id,
+                    cogset_id,
+                    row["CONCEPT"],
+                    row["IPA"],
+                    row["TOKENS"],
+                    row["ALIGNMENT"],
+                    row["STRUCTURE"],
+                    row["PATTERNS"],
+                ),
+            )
+
+            # `pattern_idx` == 0 is used for singletons, as in `chars2corr()`
+            for position, label in enumerate(row["PATTERNS"].split()):
+                if label == "+" or label.split("/")[0] == "0":
+                    continue
+                pattern_id = _get_id(
+                    cursor, "patterns", "name", pattern2char(label), patterns
+                )
+                cursor.execute(
+                    "INSERT OR IGNORE INTO sites VALUES (?, ?, ?)",
+                    (cogset_id, position, pattern_id),
+                )
+
+        for row in corr_data:
+            cursor.execute(
+                "INSERT INTO correspondences VALUES (?, ?, ?)",
+                (
+                    _get_id(cursor, "patterns", "name", row["CHAR"], patterns),
+                    _get_id(cursor, "doculects", "name", row["DOCULECT"], doculects),
+                    _get_id(cursor, "phonemes", "label", row["PHONEME"], phonemes),
+                ),
+            )
+
+        conn.commit()
+
+    logging.info(
+        "Exported %i forms and %i correspondences to `%s`.",
+        len(char_data),
+        len(corr_data),
+        filename,
+    )
+
+
+def load_char_data(filename: str) -> list:
+    """
+    Load the char rows from a SQLite database.
+
+    @param filename: The path to the database.
+    @return: The list of char rows, as returned by `get_copar_results()`.
+    """
+
+    with contextlib.closing(sqlite3.connect(filename)) as conn:
+        rows = conn.execute("""
+            SELECT forms.id, doculects.name, concept, ipa, tokens, cogsets.cogid,
+                alignment, structure, patterns
+            FROM forms
+            JOIN doculects ON doculects.id = forms.doculect_id
+            JOIN cogsets ON cogsets.id = forms.cogset_id
+            ORDER BY CAST(cogsets.cogid AS INTEGER), forms.id
+            """).fetchall()
+
+    return [dict(zip(CHAR_FIELDS, [str(row[0])] + list(row[1:]))) for row in rows]
+
+
+def load_corr_data(filename: str) -> list:
+    """
+    Load the correspondences from a SQLite database.
+
+    @param filename: The path to the database.
+    @return: The list of correspondences, as returned by `chars2corr()`.
+    """
+
+    with contextlib.closing(sqlite3.connect(filename)) as conn:
+        rows = conn.execute("""
+            SELECT doculects.name, patterns.name, phonemes.label
+            FROM correspondences
+            JOIN doculects ON doculects.id = correspondences.doculect_id
+            JOIN patterns ON patterns.id = correspondences.pattern_id
+            JOIN phonemes ON phonemes.id = correspondences.phoneme_id
+            ORDER BY patterns.name, doculects.name
+            """).fetchall()
+
+    return [
+        {"DOCULECT": doculect, "CHAR": char, "PHONEME": phoneme}
+        for doculect, char, phoneme in rows
+    ]
+
+
+def query_patterns(filename: str, doculect: str, phoneme: str) -> list:
+    """
+    Return the patterns where a doculect has a given phoneme.
+
+    @param filename: The path to the database.
+    @param doculect: The name of the doculect.
+    @param phoneme: The phoneme, either as an IPA grapheme (with "-" for
+        gaps) or as the label used in the correspondences (e.g., "_GS_").
+    @return: A sorted list of pattern names.
+    """
+
+    labels = {phoneme}
+    if phoneme == "-":
+        labels.add("ZERO")
+    else:
+        labels.add(slug_grapheme_label(phoneme))
+
+    with contextlib.closing(sqlite3.connect(filename)) as conn:
+        rows = conn.execute(
+            f"""
+            SELECT patterns.name
+            FROM correspondences
+            JOIN doculects ON doculects.id = correspondences.doculect_id
+            JOIN patterns ON patterns.id = correspondences.pattern_id
+            JOIN phonemes ON phonemes.id = correspondences.phoneme_id
+            WHERE doculects.name = ?
+                AND phonemes.label IN ({", ".join("?" * len(labels))})
+            ORDER BY patterns.name
+            """,
+            (doculect, *sorted(labels)),
+        ).fetchall()
+
+    return [row[0] for row in rows]
+
+
+def query_cogsets(filename: str, pattern: str) -> list:
+    """
+    Return the cognate sets with sites in a given pattern.
+
+    @param filename: The path to the database.
+    @param pattern: The name of the pattern, either in full (e.g., "c100_1"),
+        without the size (e.g., "c100"), or just its index (e.g., "100").
+    @return: A sorted list of cognate set IDs.
+    """
+
+    with contextlib.closing(sqlite3.connect(filename)) as conn:
+        rows = conn.execute(
+            """
+            SELECT DISTINCT cogsets.cogid
+            FROM sites
+            JOIN patterns ON patterns.id = sites.pattern_id
+            JOIN cogsets ON cogsets.id = sites.cogset_id
+            WHERE patterns.idx = ?
+            ORDER BY CAST(cogsets.cogid AS INTEGER)
+            """,
+            (_pattern_idx(pattern),),
+        ).fetchall()
+
+    return [row[0] for row in rows]
@@ -0,0 +1,130 @@
+"""
+Module for running the analysis on subsets of doculects.
+
+Robustness analyses, such as taxon jackknifing or regional subsets, require
+running the full pipeline on many subsets of the same data. The wordlist is
+parsed only once and shared with a pool of worker processes, each receiving
+it a single time at start-up, so that only the lists of doculects are sent
+for every subset.
+"""
+
+# Import Python standard libraries
+import logging
+import multiprocessing
+
+# Import local modules
+from .common import chars2corr
+from .copar import entries2matrix, get_copar_results
+from .nexus import corrdata2nexus
+from .validate import WordlistIndex
+
+# The wordlist shared by the worker processes, set by `_init_worker()`
+_WORDLIST = None
+
+
+def subset_matrix(wordlist: dict, doculects) -> dict:
+    """
+    Build a LingPy matrix with the rows of a subset of doculects.
+
+    @param wordlist: A LingPy matrix, as returned by `build_lingpy_matrix()`.
+    @param doculects: The doculects to keep.
+    @return: A new LingPy matrix with the rows of the doculects in the
+        subset, dropping the cognate sets left with a single row.
+    """
+
+    doculects = set(doculects)
+    entries = {
+        idx: row
+        for idx, row in sorted(wordlist.items())
+        if idx != 0 and row[0] in doculects
+    }
+
+    return entries2matrix(entries)
+
+
+def jackknife_subsets(source) -> dict:
+    """
+    Build the subsets for a taxon jackknife, dropping one doculect at a time.
+
+    Doculects with no entries in the analysis (i.e., only in singleton
+    cognate sets) are not dropped, as their subsets would be the full data.
+
+    @param source: A LingPy matrix, as returned by `build_lingpy_matrix()`,
+        or a `WordlistIndex`, whose doculects are used with no pass over the
+        rows.
+    @return: A dictionary from subset names (in the format `no_<doculect>`)
+        to the list of doculects in each subset.
+    """
+
+    if isinstance(source, WordlistIndex):
+        doculects = sorted(
+            doculect
+            for doculect, entry_ids in source.doculects.items()
+            if any(
+                len(source.cogsets[source.entries[entry_id][4]]) > 1
+                for entry_id in entry_ids
+            )
+        )
+    else:
+        doculects = sorted({row[0] for idx, row in source.items() if idx != 0})
+
+    return {
+        f"no_{dropped}": [doculect for doculect in doculects if doculect != dropped]
+        for dropped in doculects
+    }
+
+
+def _init_worker(wordlist: dict):
+    """
+    Store the shared wordlist in a worker process.
+    """
+
+    global _WORDLIST
+    _WORDLIST = wordlist
+
+
+def _run_subset(task):
+    """
+    Run the analysis on a subset of the shared wordlist.
+
+    @param task: A tuple with the name of the subset and its doculects.
+    @return: A tuple with the name of the subset and its NEXUS source.
+    """
+
+    name, doculects = task
+    logging.info("Running subset `%s` (%i doculects).", name, len(doculects))
+
+    matrix = subset_matrix(_WORDLIST, doculects)
+    char_data = get_copar_results(matrix, "cogid")
+    nexus_source = corrdata2nexus(chars2corr(char_data))
+
+    return name, nexus_source
+
+
+def run_subsets(wordlist: dict, subsets: dict, processes: int = None) -> dict:
+    """
+    Run the analysis on subsets of doculects, in parallel.
+
+    @param wordlist: A LingPy matrix, as returned by `build_lingpy_matrix()`.
+    @param subsets: A dictionary from subset names to lists of doculects.
+    @param processes: The number of worker processes; if `None`, the number
+        of CPUs is used, and if `1`, subsets are run in the current process.
+    @return: A dictionary from subset names to their NEXUS sources.
+    """
+
+    for name, doculects in subsets.items():
+        if len(set(doculects)) < 2:
+            raise ValueError(f"Subset `{name}` has less than two doculects.")
+
+    tasks = list(subsets.items())
+    if processes == 1:
+        _init_worker(wordlist)
+        results = [_run_subset(task) for task in tasks]
+        _init_worker(None)
+    else:
+        with multiprocessing.Pool(
+            processes, initializer=_init_worker, initargs=(wordlist,)
+        ) as pool:
+            results = pool.map(_run_subset, tasks, chunksize=1)
+
+    return dict(results)
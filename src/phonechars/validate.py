@@ -0,0 +1,219 @@
+"""
+Module for validating and indexing input wordlists before the analysis.
+
+Malformed rows (such as a missing cognate set, a non-integer ID, or an
+alignment whose length differs from the others of its cognate set) would
+otherwise only surface as errors deep inside LingPy, after the expensive
+work has started, or be silently skipped. `index_records()` checks all
+rows in a single streaming pass, reporting errors with their row numbers,
+and builds a `WordlistIndex` with the entries, the rows of each cognate set
+and doculect, and the alphabet of segments, which is used for building the
+LingPy matrix with no further pass over the data.
+"""
+
+# Import Python standard libraries
+from collections import Counter
+import csv
+import io
+
+# Import local modules
+from .copar import DEFAULT_COLUMNS, entries2matrix, record2entry
+from .events import stage
+
+# Keys of `DEFAULT_COLUMNS` whose columns must be present in the source
+REQUIRED_COLUMNS = ["id", "doculect", "concept", "alignment", "cogid"]
+
+
+class WordlistIndex:
+    """
+    Index of a validated wordlist, as built by `index_records()`.
+
+    Rows are numbered from 1, not counting the header; `entries` holds the
+    entries keyed by their IDs, as returned by `records2entries()`, while
+    `cogsets` and `doculects` map each cognate set and doculect to the IDs
+    of their entries, in order of first occurrence. `alphabet` counts the
+    segments in the alignments, and `errors` lists the messages of the rows
+    failing validation (only filled if not failing fast).
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.cogsets = {}
+        self.doculects = {}
+        self.alphabet = Counter()
+        self.errors = []
+        self.rows = 0
+
+    def singletons(self) -> list:
+        """
+        Return the cognate sets with a single entry, dropped by the analysis.
+        """
+
+        return [
+            cogid for cogid, entry_ids in self.cogsets.items() if len(entry_ids) == 1
+        ]
+
+    def matrix(self) -> dict:
+        """
+        Build the LingPy matrix, as returned by `build_lingpy_matrix()`.
+
+        @return: The LingPy matrix.
+        """
+
+        if self.errors:
+            raise ValueError(f"The wordlist has {len(self.errors)} invalid rows.")
+
+        return entries2matrix(self.entries, self.cogsets)
+
+
+def _check_alignment(alignment: list) -> str:
+    """
+    Return the error message for a malformed alignment, if any.
+    """
+
+    if not alignment:
+        return "empty alignment"
+    if alignment[0] == "+" or alignment[-1] == "+":
+        return "morpheme marker `+` at the edge of the alignment"
+    for prev, token in zip(alignment, alignment[1:]):
+        if prev == "+" and token == "+":
+            return "consecutive morpheme markers `+` in the alignment"
+
+    return None
+
+
+def index_records(
+    records, columns: dict = None, noid: bool = False, fail_fast: bool = True
+) -> WordlistIndex:
+    """
+    Validate a sequence of records in one pass, building their index.
+
+    Rows are checked for missing columns and values, non-integer or
+    duplicate IDs, malformed alignments, and alignments whose length or
+    morpheme markers differ from those of the first row of their cognate
+    set.
+
+    @param records: An iterable of dictionaries, one per row, as in
+        `records2entries()`.
+    @param columns: A dictionary overriding the default column names, as in
+        `records2entries()`.
+    @param noid: Whether to use a simple sequential index instead of the ID
+        field, as in `records2entries()`. Defaults to `False`.
+    @param fail_fast: Whether to raise a `ValueError` at the first invalid
+        row; if `False`, all errors are collected in the index. Defaults to
+        `True`.
+    @return: The `WordlistIndex`.
+    """
+
+    columns = {**DEFAULT_COLUMNS, **(columns or {})}
+    required = [columns[key] for key in REQUIRED_COLUMNS if key != "id" or not noid]
+
+    index = WordlistIndex()
+    # The first row, length, and morpheme marker positions of each cognate set
+    references = {}
+
+    def report(row: int, entry_id, message: str):
+        if entry_id is None:
+            error = f"Row {row}: {message}."
+        else:
+            error = f"Row {row} (ID {entry_id}): {message}."
+        if fail_fast:
+            raise ValueError(error)
+        index.errors.append(error)
+
+    with stage("load", "rows") as progress:
+        for idx, record in enumerate(records):
+            row = idx + 1
+            if idx == 0:
+                missing = [column for column in required if column not in record]
+                if missing:
+                    raise ValueError(
+                        f"Missing columns: {', '.join(f'`{col}`' for col in missing)}."
+                    )
+
+            # Check the ID, using the row number for the entries with invalid
+            # ones when collecting errors
+            if noid:
+                entry_id = row
+            else:
+                try:
+                    entry_id = int(record[columns["id"]])
+                except (TypeError, ValueError):
+                    report(row, None, f"non-integer ID `{record[columns['id']]}`")
+                    entry_id = None
+                else:
+                    if entry_id in index.entries:
+                        report(row, entry_id, "duplicate ID")
+                        entry_id = None
+
+            entry = record2entry(record, columns)
+            doculect, cogid, alignment = entry[0], entry[4], entry[5]
+            if not doculect:
+                report(row, entry_id, f"missing value for `{columns['doculect']}`")
+            if not cogid:
+                report(row, entry_id, f"missing value for `{columns['cogid']}`")
+
+            message = _check_alignment(alignment)
+            if message:
+                report(row, entry_id, message)
+            elif cogid:
+                markers = [pos for pos, token in enumerate(alignment) if token == "+"]
+                if cogid not in references:
+                    references[cogid] = (row, len(alignment), markers)
+                else:
+                    ref_row, ref_length, ref_markers = references[cogid]
+                    if len(alignment) != ref_length:
+                        report(
+                            row,
+                            entry_id,
+                            f"alignment has {len(alignment)} positions, but row "
+                            f"{ref_row} of cognate set `{cogid}` has {ref_length}",
+                        )
+                    elif markers != ref_markers:
+                        report(
+                            row,
+                            entry_id,
+                            "morpheme markers `+` not aligned with row "
+                            f"{ref_row} of cognate set `{cogid}`",
+                        )
+
+            if entry_id is not None:
+                index.entries[entry_id] = entry
+                index.cogsets.setdefault(cogid, []).append(entry_id)
+                index.doculects.setdefault(doculect, []).append(entry_id)
+            index.alphabet.update(
+                token for token in alignment if token not in ("-", "+")
+            )
+            index.rows = row
+            progress.advance()
+
+        progress.info["errors"] = len(index.errors)
+
+    return index
+
+
+def index_wordlist(
+    source: str,
+    delimiter: str,
+    noid: bool = False,
+    columns: dict = None,
+    fail_fast: bool = True,
+) -> WordlistIndex:
+    """
+    Validate a tabular source in one pass, building its index.
+
+    @param source: The tabular source data, as a string.
+    @param delimiter: The delimiter of the source, either "comma" or "tab".
+    @param noid: Whether to use a simple sequential index instead of the ID
+        field, as in `records2entries()`. Defaults to `False`.
+    @param columns: A dictionary overriding the default column names, as in
+        `records2entries()`.
+    @param fail_fast: Whether to raise a `ValueError` at the first invalid
+        row, as in `index_records()`. Defaults to `True`.
+    @return: The `WordlistIndex`.
+    """
+
+    delimiter_map = {"comma": ",", "tab": "\t"}
+    records = csv.DictReader(io.StringIO(source), delimiter=delimiter_map[delimiter])
+
+    return index_records(records, columns, noid, fail_fast)
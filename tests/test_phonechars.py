@@ -7,13 +7,43 @@ Tests for the `phonechars` package.
 
 # Import Python standard libraries
 from multiprocessing.context import assert_spawning
+import csv
 import hashlib
+import io
+import os
 from pathlib import Path
+import stat
+import threading
+
+# Import 3rd-party libraries
+import pytest
+import unidecode
 
 # Import the library being tested
 import phonechars
 
 TEST_DATA_PATH = Path(__file__).parent / "test_data"
+DEMO_PATH = Path(__file__).parent.parent / "demo"
+
+
+@pytest.fixture(scope="module")
+def fake1():
+    """
+    Run the analysis once on the small dataset, sharing the results.
+
+    Tests must not change the returned data.
+    """
+
+    input_file = str(TEST_DATA_PATH / "fake1.csv")
+    source = phonechars.fetch_stream_data(input_file, "utf-8")
+    wordlist = phonechars.build_lingpy_matrix(source, "comma")
+    char_data = phonechars.get_copar_results(wordlist, "cogid")
+
+    return {
+        "source": source,
+        "char_data": char_data,
+        "corr_data": phonechars.chars2corr(char_data),
+    }
 
 
 def test_copar_full():
@@ -63,3 +93,521 @@ def test_copar_full():
         m.hexdigest()
         == "b4364c18ebe91f4eae01d024cf9dfa50132b3853bd7aa451ee3bab64db3b9c87"
     )
+
+
+def test_copar_collapse(fake1):
+    """
+    Check that collapsing duplicate rows does not change the CoPAR results.
+    """
+
+    # Add duplicate entries to the small dataset, along with a row sharing an
+    # alignment but not the concept, which must not be collapsed
+    source = fake1["source"]
+    source += "\n21,LANG_A,FIRE,f a i r,FIRE_A\n22,LANG_C,AIR,v a i r -,AIR_A\n"
+    source += "23,LANG_A,BLAZE,f a i r,FIRE_A\n"
+
+    wordlist = phonechars.build_lingpy_matrix(source, "comma")
+    char_data = phonechars.get_copar_results(wordlist, "cogid")
+
+    wordlist, expansion = phonechars.collapse_duplicate_rows(
+        phonechars.build_lingpy_matrix(source, "comma")
+    )
+    assert len(wordlist) == 20  # header included
+    assert sorted(len(group) for group in expansion.values())[-2:] == [2, 2]
+    collapsed_data = phonechars.get_copar_results(wordlist, "cogid", expansion)
+
+    assert len(char_data) == 21
+    assert [row["CONCEPT"] for row in collapsed_data].count("BLAZE") == 1
+    assert collapsed_data == char_data
+
+
+def test_copar_incremental(tmp_path, fake1):
+    """
+    Check the incremental update of the state of a CoPAR run.
+    """
+
+    source, char_data = fake1["source"], fake1["char_data"]
+    lines = source.splitlines()
+
+    # The state of a full run must hold the same results
+    state = phonechars.build_copar_state(source, "comma")
+    assert phonechars.incremental.state2chars(state) == char_data
+    index = phonechars.index_wordlist(source, "comma")
+    assert phonechars.build_copar_state(index, None) == state
+
+    # Updating with unchanged rows must not change anything
+    report = phonechars.update_copar_state(state, "\n".join(lines[:6]), "comma")
+    assert report == {"added": [], "removed": [], "changed": []}
+    assert phonechars.incremental.state2chars(state) == char_data
+
+    # Add a new doculect to the FIRE cognate set
+    delta = "\n".join([lines[0], "21,LANG_F,FIRE,v e i r,FIRE_A"])
+    index = phonechars.index_wordlist(delta, "comma")
+    report = phonechars.update_copar_state(state, index, None)
+    assert report["changed"] == ["c1_2", "c2_2", "c3_2", "c4_3"]
+    new_char_data = phonechars.incremental.state2chars(state)
+    assert len(new_char_data) == 19
+    assert new_char_data[5]["DOCULECT"] == "LANG_F"
+    assert new_char_data[5]["PATTERNS"].split()[0] == "1-2/f"
+
+    # The state is written atomically and loaded back unchanged
+    state_file = tmp_path / "fake1.state.json.gz"
+    phonechars.incremental.save_state(state, state_file)
+    assert phonechars.incremental.load_state(state_file) == state
+    assert [path.name for path in tmp_path.iterdir()] == [state_file.name]
+
+
+def test_run_subsets(fake1):
+    """
+    Check runs on subsets of doculects against runs on the filtered data.
+    """
+
+    source = fake1["source"]
+    wordlist = phonechars.build_lingpy_matrix(source, "comma")
+
+    subsets = phonechars.subsets.jackknife_subsets(wordlist)
+    assert len(subsets) == 5
+    assert subsets["no_LANG_A"] == ["LANG_B", "LANG_C", "LANG_D", "LANG_E"]
+
+    # Doculects of the index only found in singletons are not dropped
+    index = phonechars.index_wordlist(
+        "\n".join([source.rstrip(), "21,LANG_F,WATER,wasser,w a s e r,WATER_A"]),
+        "comma",
+    )
+    assert "LANG_F" in index.doculects
+    assert phonechars.subsets.jackknife_subsets(index) == subsets
+
+    results = phonechars.run_subsets(wordlist, subsets, processes=2)
+    assert sorted(results) == sorted(subsets)
+
+    # Compare with a run on the data without LANG_A
+    filtered = "\n".join(line for line in source.splitlines() if ",LANG_A," not in line)
+    wordlist = phonechars.build_lingpy_matrix(filtered, "comma")
+    char_data = phonechars.get_copar_results(wordlist, "cogid")
+    nexus_source = phonechars.corrdata2nexus(phonechars.chars2corr(char_data))
+    assert results["no_LANG_A"] == nexus_source
+
+
+def test_smart_open_compression(tmp_path, fake1):
+    """
+    Check the transparent reading and writing of compressed streams.
+    """
+
+    source = fake1["source"]
+
+    compressions = ["gzip", "xz"]
+    if phonechars.common.zstandard:
+        compressions.append("zstd")
+
+    for compression in compressions:
+        # Compression detected by the extension
+        extension = phonechars.common.COMPRESSION_EXTENSIONS[compression]
+        filename = tmp_path / f"fake1.csv{extension}"
+        with phonechars.common.smart_open(filename, "w", encoding="utf-8") as handler:
+            handler.write(source)
+        assert phonechars.common.detect_compression(filename) == compression
+        assert phonechars.fetch_stream_data(str(filename), "utf-8") == source
+
+        # Compression detected by the magic bytes
+        filename = tmp_path / f"fake1_{compression}.csv"
+        with phonechars.common.smart_open(
+            filename, "w", encoding="utf-8", compression=compression
+        ) as handler:
+            handler.write(source)
+        with open(filename, "rb") as handler:
+            assert phonechars.common.detect_compression("", handler.read(6)) == (
+                compression
+            )
+        with phonechars.common.smart_open(filename, encoding="utf-8") as handler:
+            assert handler.read() == source
+
+    # Detection must not consume streams which can only be read once
+    fifo = tmp_path / "fake1.fifo"
+    os.mkfifo(fifo)
+    writer = threading.Thread(target=fifo.write_text, args=(source, "utf-8"))
+    writer.start()
+    assert phonechars.fetch_stream_data(str(fifo), "utf-8") == source
+    writer.join()
+
+
+def test_sqlite_store(tmp_path, fake1):
+    """
+    Check the export to, queries on, and loading from a SQLite database.
+    """
+
+    char_data, corr_data = fake1["char_data"], fake1["corr_data"]
+
+    database = str(tmp_path / "fake1.db")
+    phonechars.export_sqlite(database, char_data)
+
+    assert phonechars.store.load_char_data(database) == char_data
+    assert phonechars.store.load_corr_data(database) == corr_data
+    assert phonechars.store.query_patterns(database, "LANG_D", "e") == [
+        "c2_2",
+        "c7_2",
+    ]
+    assert phonechars.store.query_patterns(database, "LANG_D", "-") == ["c3_2"]
+    assert phonechars.store.query_cogsets(database, "c2") == ["1", "6"]
+
+
+def test_input_adapters(tmp_path, fake1):
+    """
+    Check that the input adapters build the same matrix as tabular sources.
+    """
+
+    input_file = str(TEST_DATA_PATH / "fake1.csv")
+    wordlist = phonechars.build_lingpy_matrix(fake1["source"], "comma")
+
+    with open(input_file, encoding="utf-8") as handler:
+        rows = list(csv.DictReader(handler))
+
+    # Build a CLDF dataset without metadata, using the default table names
+    with open(tmp_path / "forms.csv", "w", encoding="utf-8") as handler:
+        writer = csv.writer(handler)
+        writer.writerow(["ID", "Language_ID", "Parameter_ID", "Form"])
+        for row in rows:
+            form = row["ALIGNMENT"].replace("-", "").replace(" ", "")
+            writer.writerow([f"f{row['ID']}", row["DOCULECT"], row["CONCEPT"], form])
+    with open(tmp_path / "cognates.csv", "w", encoding="utf-8") as handler:
+        writer = csv.writer(handler)
+        writer.writerow(["ID", "Form_ID", "Cognateset_ID", "Alignment"])
+        for row in rows:
+            writer.writerow(
+                [f"c{row['ID']}", f"f{row['ID']}", row["COGID"], row["ALIGNMENT"]]
+            )
+    assert phonechars.cldf2matrix(tmp_path) == wordlist
+
+    # Data frames, with a custom column name and token lists
+    pandas = pytest.importorskip("pandas")
+    frame = pandas.DataFrame(rows).rename(columns={"CONCEPT": "GLOSS"})
+    frame["ALIGNMENT"] = frame["ALIGNMENT"].str.split()
+    frame["EXTRA"] = None
+    assert phonechars.table2matrix(frame, columns={"concept": "GLOSS"}) == wordlist
+
+
+def test_matrix_formats(fake1):
+    """
+    Check the writers for the character matrix in other formats.
+    """
+
+    corr_data = fake1["corr_data"]
+    matrix_data = phonechars.nexus.corrdata2matrix(corr_data)
+
+    handler = io.StringIO()
+    phonechars.formats.write_nexus(handler, *matrix_data)
+    assert handler.getvalue() == phonechars.corrdata2nexus(corr_data)
+
+    handler = io.StringIO()
+    phonechars.write_phylip(handler, *matrix_data)
+    lines = handler.getvalue().splitlines()
+    assert lines[0] == "5 27"
+    assert lines[5] == "LANG_E 0010100010100??0??0100??0??"
+
+    handler = io.StringIO()
+    phonechars.write_fasta(handler, *matrix_data)
+    lines = handler.getvalue().splitlines()
+    assert lines[:2] == [">LANG_A", "010010001001010001001001001"]
+
+    handler = io.StringIO()
+    phonechars.write_beast_xml(handler, *matrix_data)
+    lines = handler.getvalue().splitlines()
+    assert len(lines) == 16
+    assert 'filter="4-6"' in lines[8]
+
+
+def test_progress_events(fake1):
+    """
+    Check the events emitted through the pipeline.
+    """
+
+    events = []
+    phonechars.add_listener(events.append)
+    try:
+        wordlist = phonechars.build_lingpy_matrix(fake1["source"], "comma")
+        char_data = phonechars.get_copar_results(wordlist, "cogid")
+        phonechars.corrdata2nexus(phonechars.chars2corr(char_data))
+    finally:
+        phonechars.remove_listener(events.append)
+
+    ends = {event["stage"]: event for event in events if event["event"] == "stage_end"}
+    assert list(ends) == [
+        "load",
+        "structure",
+        "sites",
+        "clusters",
+        "patterns",
+        "export",
+        "correspondences",
+        "matrix",
+    ]
+    assert ends["load"]["count"] == 20
+    assert ends["sites"]["count"] == 17
+    assert (ends["clusters"]["count"], ends["clusters"]["merged"]) == (9, 2)
+    assert ends["matrix"]["count"] == 9
+    assert len([event for event in events if event["event"] == "stage_start"]) == 8
+
+
+def test_spill(fake1):
+    """
+    Check that the memory-bounded functions match the in-memory ones.
+    """
+
+    char_data, corr_data = fake1["char_data"], fake1["corr_data"]
+
+    # A limit of a few hundred bytes forces several spilled chunks
+    spilled_corr = phonechars.chars2corr_spill(iter(char_data), 300)
+    assert list(spilled_corr) == corr_data
+
+    taxa, charstates, assumptions, all_chars, matrix = phonechars.corrdata2matrix_spill(
+        iter(corr_data), 300
+    )
+    assert (taxa, charstates, assumptions, all_chars, dict(matrix)) == (
+        phonechars.nexus.corrdata2matrix(corr_data)
+    )
+
+    handler = io.StringIO()
+    phonechars.formats.write_nexus(
+        handler, taxa, charstates, assumptions, all_chars, matrix
+    )
+    assert handler.getvalue() == phonechars.corrdata2nexus(corr_data)
+
+    unsorted = [corr_data[0], corr_data[-1], corr_data[1]]
+    with pytest.raises(ValueError):
+        phonechars.corrdata2matrix_spill(unsorted, 300)
+
+
+def test_unslug_labels():
+    """
+    Check the decoding of slugged labels back to IPA.
+    """
+
+    # All graphemes of the demo data with an ASCII X-SAMPA equivalent must be
+    # recovered, also when marked as irregular
+    with open(DEMO_PATH / "ryukyu.tsv", encoding="utf-8") as handler:
+        tokens = {
+            token
+            for row in csv.DictReader(handler, delimiter="\t")
+            for token in row["ALIGNMENT"].split()
+        }
+    graphemes = [
+        token
+        for token in sorted(tokens - {"-", "+"})
+        if phonechars.ipa.xsampa2ipa(
+            unidecode.unidecode(phonechars.ipa2xsampa(token, None))
+        )
+        == token
+    ]
+    assert len(graphemes) == 52
+    graphemes += [f"!{grapheme}" for grapheme in graphemes] + ["!-"]
+    slugs = [phonechars.common.slug_grapheme_label(grapheme) for grapheme in graphemes]
+    assert phonechars.unslug_labels(slugs) == graphemes
+
+    charstates = ["c12_2_ascertainment", "c12_2__GS_", "c12_2_ZERO", "c3_4_TONE_1"]
+    assert phonechars.unslug_labels(charstates) == [None, "ʔ", "-", "ɨ"]
+
+
+def test_parallel_structure(monkeypatch, caplog, fake1):
+    """
+    Check that annotating the structure in parallel matches the serial path.
+    """
+
+    # Small wordlists are always annotated serially
+    monkeypatch.setattr(phonechars.copar, "PARALLEL_STRUCTURE_MIN_ROWS", 1)
+    caplog.set_level("INFO")
+    parallel = phonechars.get_copar_results(
+        phonechars.build_lingpy_matrix(fake1["source"], "comma"), "cogid", processes=2
+    )
+
+    assert parallel == fake1["char_data"]
+    assert "with 2 processes (serial annotation: " in caplog.text
+
+
+def test_replicates(fake1):
+    """
+    Check seeded runs and the consensus of replicates.
+    """
+
+    source = fake1["source"]
+    seeded = [
+        phonechars.get_copar_results(
+            phonechars.build_lingpy_matrix(source, "comma"), "cogid", seed=7
+        )
+        for _ in range(2)
+    ]
+    assert seeded[0] == seeded[1]
+
+    wordlist = phonechars.build_lingpy_matrix(source, "comma")
+    char_data, consensus = phonechars.run_replicates(wordlist, 2, processes=1)
+    assert char_data == fake1["char_data"]
+    assert len(consensus) == 17
+    assert all(0 < site["STABILITY"] <= 1 for site in consensus)
+
+    # Ties in the votes are broken in favor of the reference
+    reference = {("1", 0): "1", ("1", 1): "2", ("2", 0): "1"}
+    replicate = {("1", 0): "5", ("1", 1): "6", ("2", 0): "6"}
+    assert phonechars.replicates.consensus_patterns(reference, [replicate]) == [
+        {"COGID": "1", "POSITION": 0, "PATTERN": "1", "STABILITY": 1.0},
+        {"COGID": "1", "POSITION": 1, "PATTERN": "2", "STABILITY": 0.5},
+        {"COGID": "2", "POSITION": 0, "PATTERN": "1", "STABILITY": 1.0},
+    ]
+
+
+def test_sparse_corr_matrix(fake1):
+    """
+    Check the sparse pattern × doculect matrix of correspondences.
+    """
+
+    char_data, corr_data = fake1["char_data"], fake1["corr_data"]
+    corr_matrix = phonechars.chars2corr(char_data, sparse=True)
+
+    assert corr_matrix.shape == (9, 5)
+    assert corr_matrix.nnz == len(corr_data)
+    assert corr_matrix.to_rows() == corr_data
+    assert phonechars.corrdata2nexus(corr_matrix) == phonechars.corrdata2nexus(
+        corr_data
+    )
+
+    # Slicing and filtering
+    assert corr_matrix.row("c1_2") == {
+        "LANG_A": ["f"],
+        "LANG_B": ["f"],
+        "LANG_C": ["v"],
+        "LANG_D": ["f"],
+        "LANG_E": ["v"],
+    }
+    assert corr_matrix.column("LANG_E")["c1_2"] == ["v"]
+    for doculect in corr_matrix.doculects:
+        assert corr_matrix.column(doculect) == {
+            pattern: corr_matrix.row(pattern)[doculect]
+            for pattern in corr_matrix.patterns
+            if doculect in corr_matrix.row(pattern)
+        }
+    subset = corr_matrix.select_doculects(["LANG_A", "LANG_E"])
+    assert subset.to_rows() == [
+        row for row in corr_data if row["DOCULECT"] in ["LANG_A", "LANG_E"]
+    ]
+    assert corr_matrix.select_patterns(["c1_2"]).shape == (1, 5)
+    assert corr_matrix.filter_coverage(5).patterns == [
+        pattern
+        for pattern, coverage in zip(corr_matrix.patterns, corr_matrix.coverage())
+        if coverage == 5
+    ]
+
+
+def test_prune_characters(fake1):
+    """
+    Check the pruning of characters before building the matrix.
+    """
+
+    corr_matrix = phonechars.chars2corr(fake1["char_data"], sparse=True)
+
+    pruned, removed = corr_matrix.prune(min_doculects=5, informative=True)
+    assert pruned.patterns == ["c1_2", "c4_3", "c7_2"]
+    assert removed == {
+        "min_doculects": 4,
+        "min_states": 0,
+        "informative": 2,
+        "max_states": 0,
+    }
+
+    # Rules are counted in order, and pruning nothing keeps the NEXUS output
+    assert corr_matrix.prune(min_states=3, max_states=1)[1]["min_states"] == 9
+    assert corr_matrix.prune(min_states=3)[0].shape == (0, 5)
+
+    # Doculects are kept as taxa with missing data when all their entries are
+    # pruned
+    pruned = corr_matrix.select_patterns(["c5_2"])
+    assert pruned.shape == (1, 5)
+    assert phonechars.nexus.corrdata2matrix(pruned)[-1]["LANG_E"] == "0??"
+    assert phonechars.corrdata2nexus(corr_matrix.prune()[0]) == (
+        phonechars.corrdata2nexus(corr_matrix)
+    )
+
+
+def test_output_writer(tmp_path):
+    """
+    Check the atomic writing of outputs and their manifest.
+    """
+
+    manifest = tmp_path / "out.manifest.json"
+    with phonechars.OutputWriter(manifest) as outputs:
+        outputs.submit(tmp_path / "a.tsv", lambda handler: handler.write("a\tb\n"))
+        outputs.submit(tmp_path / "b.nex.gz", lambda handler: handler.write("#NEXUS"))
+    assert (tmp_path / "a.tsv").read_text(encoding="utf-8") == "a\tb\n"
+    assert phonechars.verify_manifest(manifest) == []
+
+    (tmp_path / "a.tsv").write_text("changed", encoding="utf-8")
+    assert phonechars.verify_manifest(manifest) == ["a.tsv"]
+
+    # A failing output discards all of them, with no temporary files left
+    def fail(handler):
+        handler.write("partial")
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        with phonechars.OutputWriter(tmp_path / "new.manifest.json") as outputs:
+            outputs.submit(tmp_path / "c.tsv", lambda handler: handler.write("c"))
+            outputs.submit(tmp_path / "d.tsv", fail)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "a.tsv",
+        "b.nex.gz",
+        "out.manifest.json",
+    ]
+
+    with phonechars.atomic_open(tmp_path / "a.tsv") as handler:
+        handler.write("a")
+    assert (tmp_path / "a.tsv").read_text(encoding="utf-8") == "a"
+
+    # Outputs get the default mode of new files, or keep that of the target
+    umask = os.umask(0o022)
+    try:
+        with phonechars.OutputWriter(tmp_path / "mode.manifest.json") as outputs:
+            outputs.submit(tmp_path / "e.tsv", lambda handler: handler.write("e"))
+        os.chmod(tmp_path / "a.tsv", 0o640)
+        with phonechars.atomic_open(tmp_path / "a.tsv") as handler:
+            handler.write("a")
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(tmp_path / "e.tsv").st_mode) == 0o644
+    assert stat.S_IMODE(os.stat(tmp_path / "mode.manifest.json").st_mode) == 0o644
+    assert stat.S_IMODE(os.stat(tmp_path / "a.tsv").st_mode) == 0o640
+
+
+def test_validate_wordlist(fake1):
+    """
+    Check the pre-flight validation and index of input wordlists.
+    """
+
+    source = fake1["source"]
+    index = phonechars.index_wordlist(source, "comma")
+    assert (index.rows, len(index.cogsets), len(index.doculects)) == (20, 6, 5)
+    assert len(index.singletons()) == 2
+    assert index.matrix() == phonechars.build_lingpy_matrix(source, "comma")
+
+    source = "\n".join(
+        [
+            "ID,DOCULECT,CONCEPT,ALIGNMENT,COGID",
+            "1,A,x,a b,1",
+            "x2,B,x,a c,1",
+            "3,B,y,a b c,1",
+            "4,C,y,+ a,2",
+            "5,D,z,a b,",
+            "5,D,z,a b,3",
+        ]
+    )
+    with pytest.raises(ValueError, match="Row 2: non-integer ID"):
+        phonechars.index_wordlist(source, "comma")
+
+    index = phonechars.index_wordlist(source, "comma", fail_fast=False)
+    assert index.errors == [
+        "Row 2: non-integer ID `x2`.",
+        "Row 3 (ID 3): alignment has 3 positions, but row 1 of cognate set `1` has 2.",
+        "Row 4 (ID 4): morpheme marker `+` at the edge of the alignment.",
+        "Row 5 (ID 5): missing value for `COGID`.",
+        "Row 6 (ID 5): duplicate ID.",
+    ]
+    with pytest.raises(ValueError):
+        index.matrix()
+
+    with pytest.raises(ValueError, match="Missing columns: `COGID`"):
+        phonechars.index_wordlist("ID,DOCULECT,CONCEPT,ALIGNMENT\n1,A,x,a", "comma")